@@ -0,0 +1,322 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Local stand-ins for the Orthanc and DHIS2 servers used by the ecopulmonar package, with configurable latency and payload sizes.
+# Every request is recorded (endpoint, duration, bytes) so the benchmark can report throughput and latency percentiles
+
+import json
+import re
+import threading
+import time
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+
+try:
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+except ImportError:  # Optional: /instances/{id}/file answers 404 and the pipeline falls back to the previews
+    pydicom = None
+
+DE_PATOLOGIA = "H2vzpa4ZFCf"
+DE_ULTRASOUND_DATE = "aY2MfS8YVdd"
+TEA_ID_UNICO = "ofdWjpgwzfe"
+
+
+@dataclass
+class Scenario:
+    patients: int = 5
+    instances: int = 2  # Instances (videos) per patient. Patología is set so up to 5 are uploaded
+    frames: int = 40
+    width: int = 640
+    height: int = 480
+    days: int = 1  # The patients are spread over this number of days, from the run date backwards
+    orthanc_latency: float = 0.0  # Seconds added to each Orthanc request
+    dhis2_latency: float = 0.0  # Seconds added to each DHIS2 request
+    storage_delay: float = 1.0  # Seconds until an uploaded file resource is STORED
+    frame_time: float = 33.3  # FrameTime (ms) of the instances
+
+
+SCENARIOS = {
+    "small": Scenario(),
+    "daily": Scenario(patients=50, instances=5, frames=300, orthanc_latency=0.005, dhis2_latency=0.02),
+    "busy": Scenario(patients=200, instances=5, frames=300, orthanc_latency=0.005, dhis2_latency=0.02),
+    "backfill": Scenario(patients=200, instances=2, frames=60, days=40, orthanc_latency=0.005, dhis2_latency=0.02),
+}
+
+
+def uid(prefix, number):
+    return f"{prefix}{number:0{11 - len(prefix)}d}"
+
+
+class FakeData:
+    def __init__(self, scenario, start_date):
+        self.scenario = scenario
+        self.patients = []
+        for p in range(scenario.patients):
+            study_date = start_date.fromordinal(start_date.toordinal() - p % scenario.days)
+            self.patients.append({
+                "id_unico": f"P{p:06d}",
+                "tei": uid("T", p),
+                "event": uid("E", p),
+                "date": study_date,
+                "study": f"study-{p}",
+                "series": f"series-{p}",
+                "instances": [f"instance-{p}-{i}" for i in range(scenario.instances)],
+            })
+        self.instance_owner = {instance: patient for patient in self.patients for instance in patient["instances"]}
+        # A few distinct frames are enough. Blurred speckle on a black background compresses like an ultrasound frame
+        rng = np.random.default_rng(0)
+        self.frames = []
+        for _ in range(4):
+            frame = np.zeros((scenario.height, scenario.width, 3), dtype=np.uint8)
+            speckle = rng.integers(0, 256, (scenario.height // 2, scenario.width // 2, 3), dtype=np.uint8)
+            frame[scenario.height // 4:scenario.height // 4 + speckle.shape[0], scenario.width // 4:scenario.width // 4 + speckle.shape[1]] = cv2.GaussianBlur(speckle, (5, 5), 0)
+            self.frames.append(cv2.imencode(".png", frame)[1].tobytes())
+        self.dicom = None
+        self.lock = threading.Lock()
+
+    def dicom_file(self):
+        with self.lock:
+            if self.dicom is None:
+                s = self.scenario
+                ds = Dataset()
+                ds.file_meta = FileMetaDataset()
+                ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.3.1"  # Ultrasound Multi-frame
+                ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+                ds.SOPClassUID = ds.file_meta.MediaStorageSOPClassUID
+                ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+                ds.Rows, ds.Columns, ds.NumberOfFrames = s.height, s.width, s.frames
+                ds.SamplesPerPixel, ds.PhotometricInterpretation, ds.PlanarConfiguration = 3, "RGB", 0
+                ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 8, 8, 7, 0
+                ds.FrameTime = str(s.frame_time)
+                frames = [cv2.imdecode(np.frombuffer(frame, np.uint8), cv2.IMREAD_COLOR) for frame in self.frames]
+                ds.PixelData = b"".join(frames[n % len(frames)].tobytes() for n in range(s.frames))
+                buffer = BytesIO()
+                ds.save_as(buffer, enforce_file_format=True)
+                self.dicom = buffer.getvalue()
+            return self.dicom
+
+
+# Records (endpoint, start, duration, bytes received, bytes sent) of every request
+class RequestLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def add(self, endpoint, start, duration, received, sent):
+        with self.lock:
+            self.records.append((endpoint, start, duration, received, sent))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "Fake"
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    # The request is timed from its request line on: on a keep-alive connection handle_one_request first waits for the
+    # client's next request, and that idle time is not part of the request
+    def parse_request(self):
+        self.start = time.monotonic()
+        self.received = 0
+        return super().parse_request()
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        self.received = length
+        return body
+
+    def reply(self, endpoint, code, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.log.add(endpoint, self.start, time.monotonic() - self.start, self.received, len(body))
+
+
+class OrthancHandler(Handler):
+    def do_GET(self):
+        data = self.server.data
+        url = urlparse(self.path)
+        path = url.path
+        if path == "/changes":
+            return self.reply("orthanc changes", 200, self.changes(parse_qs(url.query, keep_blank_values=True)))
+        match = re.fullmatch(r"/instances/([^/]+)/frames/(\d+)/preview", path)
+        if match:
+            return self.reply("orthanc frame", 200, data.frames[int(match.group(2)) % len(data.frames)], "image/png")
+        match = re.fullmatch(r"/instances/([^/]+)/file", path)
+        if match:
+            if pydicom is None:
+                return self.reply("orthanc file", 404, {})
+            return self.reply("orthanc file", 200, data.dicom_file(), "application/dicom")
+        match = re.fullmatch(r"/instances/([^/]+)/content/0018-1063", path)
+        if match:
+            return self.reply("orthanc instance", 200, str(data.scenario.frame_time).encode(), "text/plain")
+        match = re.fullmatch(r"/instances/([^/]+)/content/[^/]+", path)
+        if match:
+            return self.reply("orthanc instance", 404, {})
+        match = re.fullmatch(r"/instances/([^/]+)", path)
+        if match and match.group(1) in data.instance_owner:
+            return self.reply("orthanc instance", 200, self.instance(match.group(1)))
+        match = re.fullmatch(r"/series/([^/]+)", path)
+        if match:
+            for patient in data.patients:
+                if patient["series"] == match.group(1):
+                    return self.reply("orthanc series", 200, self.series(patient))
+        match = re.fullmatch(r"/studies/([^/]+)", path)
+        if match:
+            for patient in data.patients:
+                if patient["study"] == match.group(1):
+                    return self.reply("orthanc study", 200, self.study(patient))
+        return self.reply("orthanc other", 404, {})
+
+    def instance(self, instance_id):
+        frames = str(self.server.data.scenario.frames)
+        return {"ID": instance_id, "Type": "Instance", "FileUuid": "file-" + instance_id, "FileSize": 0,
+                "ParentSeries": self.server.data.instance_owner[instance_id]["series"],
+                "MainDicomTags": {"NumberOfFrames": frames},
+                "RequestedTags": {"NumberOfFrames": frames, "FrameTime": str(self.server.data.scenario.frame_time)}}
+
+    def series(self, patient):
+        return {"ID": patient["series"], "Type": "Series", "ParentStudy": patient["study"], "Instances": patient["instances"]}
+
+    def study(self, patient):
+        return {"ID": patient["study"], "Type": "Study", "ParentPatient": "patient-" + patient["id_unico"],
+                "MainDicomTags": {"StudyDate": patient["date"].strftime("%Y%m%d")},
+                "PatientMainDicomTags": {"PatientID": patient["id_unico"]},
+                "Series": [patient["series"]]}
+
+    # Every patient has a StableSeries and a StableStudy change, in the order of the patients
+    def changes(self, query):
+        changes = []
+        for p, patient in enumerate(self.server.data.patients):
+            changes.append({"Seq": 2 * p + 1, "ChangeType": "StableSeries", "ResourceType": "Series", "ID": patient["series"]})
+            changes.append({"Seq": 2 * p + 2, "ChangeType": "StableStudy", "ResourceType": "Study", "ID": patient["study"]})
+        if "last" in query:
+            return {"Changes": changes[-1:], "Done": True, "Last": len(changes)}
+        since = int(query.get("since", ["0"])[0])
+        limit = int(query.get("limit", ["100"])[0])
+        batch = [change for change in changes if change["Seq"] > since][:limit]
+        return {"Changes": batch, "Done": since + len(batch) >= len(changes), "Last": batch[-1]["Seq"] if batch else since}
+
+    def do_POST(self):
+        data = self.server.data
+        path = urlparse(self.path).path
+        body = self.read_body()
+        if path != "/tools/find":
+            return self.reply("orthanc other", 404, {})
+        find = json.loads(body)
+        query = find.get("Query", {})
+        patients = [patient for patient in data.patients
+                    if ("StudyDate" not in query or patient["date"].strftime("%Y%m%d") == query["StudyDate"])
+                    and ("PatientID" not in query or patient["id_unico"] == query["PatientID"])]
+        if find["Level"] == "Study":
+            result = [self.study(patient) for patient in patients]
+        elif find["Level"] == "Series":
+            result = [self.series(patient) for patient in patients]
+        elif find["Level"] == "Instance":
+            result = [self.instance(instance) for patient in patients for instance in patient["instances"]]
+        else:
+            result = []
+        return self.reply("orthanc find", 200, result)
+
+
+class DHIS2Handler(Handler):
+    def page(self, endpoint, resource, records, query):
+        if query.get("paging", ["true"])[0] == "false":
+            return self.reply(endpoint, 200, {resource: records})
+        page_size = int(query.get("pageSize", ["50"])[0])
+        page = int(query.get("page", ["1"])[0])
+        page_count = max(1, (len(records) + page_size - 1) // page_size)
+        pager = {"page": page, "pageCount": page_count, "total": len(records), "pageSize": page_size}
+        if page < page_count:
+            pager["nextPage"] = "next"
+        return self.reply(endpoint, 200, {"pager": pager, resource: records[(page - 1) * page_size:page * page_size]})
+
+    def do_GET(self):
+        data = self.server.data
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.endswith("/events.json"):
+            low, high = "0000-00-00", "9999-99-99"
+            for date_filter in query.get("filter", []):
+                operators = date_filter.split(":")[1:]
+                for operator, value in zip(operators[::2], operators[1::2]):
+                    if operator in ("eq", "ge"):
+                        low = value
+                    if operator in ("eq", "le"):
+                        high = value
+            events = [{"event": patient["event"], "trackedEntityInstance": patient["tei"],
+                       "dataValues": [{"dataElement": DE_PATOLOGIA, "value": "1"},
+                                      {"dataElement": DE_ULTRASOUND_DATE, "value": patient["date"].isoformat() + "T00:00:00.000"}]}
+                      for patient in data.patients if low <= patient["date"].isoformat() <= high
+                      and patient["tei"] in query.get("trackedEntityInstance", [patient["tei"]])]
+            return self.page("dhis2 events", "events", events, query)
+        if url.path.endswith("/trackedEntityInstances.json"):
+            uids = set(";".join(query.get("trackedEntityInstance", [])).split(";"))
+            for tei_filter in query.get("filter", []):
+                if tei_filter.startswith(TEA_ID_UNICO + ":eq:"):
+                    uids |= {patient["tei"] for patient in data.patients if patient["id_unico"] == tei_filter.split(":", 2)[2]}
+            teis = [{"trackedEntityInstance": patient["tei"], "attributes": [{"attribute": TEA_ID_UNICO, "value": patient["id_unico"]}]}
+                    for patient in data.patients if patient["tei"] in uids]
+            return self.page("dhis2 teis", "trackedEntityInstances", teis, query)
+        match = re.search(r"/fileResources/(\w+)$", url.path)
+        if match:
+            with self.server.lock:
+                stored_at = self.server.file_resources.get(match.group(1))
+            if stored_at is None:
+                return self.reply("dhis2 storage status", 404, {})
+            status = "STORED" if time.monotonic() >= stored_at else "PENDING"
+            return self.reply("dhis2 storage status", 200, {"id": match.group(1), "storageStatus": status})
+        return self.reply("dhis2 other", 404, {})
+
+    def do_POST(self):
+        body = self.read_body()
+        if not urlparse(self.path).path.endswith("/fileResources"):
+            return self.reply("dhis2 other", 404, {})
+        if not body.startswith(b"--"):
+            return self.reply("dhis2 upload", 400, {"message": "Expected multipart/form-data"})
+        with self.server.lock:
+            file_resource_uid = uid("F", len(self.server.file_resources))
+            self.server.file_resources[file_resource_uid] = time.monotonic() + self.server.data.scenario.storage_delay
+        return self.reply("dhis2 upload", 202, {"response": {"fileResource": {"id": file_resource_uid, "storageStatus": "PENDING"}}})
+
+    def do_PUT(self):
+        self.read_body()
+        with self.server.lock:
+            self.server.attached += 1
+        return self.reply("dhis2 event update", 200, {"status": "OK"})
+
+
+def start_server(handler, latency, data):
+    handler_class = type(handler.__name__, (handler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    server.data = data
+    server.log = RequestLog()
+    server.lock = threading.Lock()
+    server.file_resources = {}
+    server.attached = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Returns the (orthanc, dhis2) servers, listening on free local ports
+def start_fakes(scenario, start_date):
+    data = FakeData(scenario, start_date)
+    return start_server(OrthancHandler, scenario.orthanc_latency, data), start_server(DHIS2Handler, scenario.dhis2_latency, data)
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Runs the whole pipeline of the ecopulmonar package against the local fake Orthanc and DHIS2 servers and reports, per stage, the
+# number of requests, bytes, throughput and latency percentiles, plus the wall time, the peak RSS and the metrics
+# recorded by the pipeline itself.
+#
+#   python benchmarks/run_benchmark.py --scenario busy --output busy.json
+#   python benchmarks/run_benchmark.py --scenario busy --set frame_source=file --baseline busy.json
+
+import argparse
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict, fields, replace
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import fakes  # noqa: E402
+
+
+def write_credentials(workdir, orthanc, dhis2, settings):
+    options = {
+        "dhis2_server": f"http://127.0.0.1:{dhis2.server_address[1]}/api/",
+        "dhis2_server_name": "benchmark",
+        "dhis2_user": "user",
+        "dhis2_password": "pwd",
+        "dhis2_page_size": "500",
+        "orthanc_server": f"http://127.0.0.1:{orthanc.server_address[1]}",
+        "orthanc_username": "user",
+        "orthanc_password": "pwd",
+        "storage_poll_initial": "0.5",
+    }
+    options.update(settings)
+    with open(os.path.join(workdir, "credentials.ini"), "w", encoding="utf-8") as f:
+        f.write("[ecopulmonar]\n")
+        for key, value in options.items():
+            f.write(f"{key}={value}\n")
+    for directory in ("images", "videos", "logs"):
+        os.mkdir(os.path.join(workdir, directory))
+
+
+# The encode workers are started by a forkserver, so they are not children of the pipeline process and are not in its
+# RUSAGE_CHILDREN. Their peak RSS is sampled from /proc until stop is set. Returns a function that gives the max in MB
+def sample_descendants_peak_rss(stop, interval=0.1):
+    peak = [0]
+
+    def descendants():
+        parents = {}
+        for pid in filter(str.isdigit, os.listdir("/proc")):
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    parents[int(pid)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+        found, pending = set(), [os.getpid()]
+        while pending:
+            parent = pending.pop()
+            children = [pid for pid, ppid in parents.items() if ppid == parent and pid not in found]
+            found.update(children)
+            pending.extend(children)
+        return found
+
+    def sample():
+        while not stop.wait(interval):
+            for pid in descendants():
+                try:
+                    with open(f"/proc/{pid}/status") as f:
+                        peak[0] = max([peak[0]] + [int(line.split()[1]) for line in f if line.startswith("VmHWM:")])
+                except (OSError, ValueError):
+                    continue
+
+    threading.Thread(target=sample, daemon=True).start()
+    return lambda: peak[0] / 1024
+
+
+# Runs in a fresh process so its peak RSS only accounts for the pipeline. Processes the dates the same way as the sync
+# command of the ecopulmonar package
+def run_pipeline(workdir, run_date, days, results):
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    start = time.monotonic()
+    cli = importlib.import_module("ecopulmonar.cli")
+    pipeline_module = importlib.import_module("ecopulmonar.pipeline")
+    from ecopulmonar.metrics import metrics
+    import_time = time.monotonic() - start
+    config = cli.Config.load("credentials.ini")
+    filename_metrics = cli.setup_logging(config)
+    stop_sampling = threading.Event()
+    peak_rss_workers = sample_descendants_peak_rss(stop_sampling)
+    pipeline_module.Pipeline(config).sync(run_date - datetime.timedelta(days=days - 1), run_date)
+    stop_sampling.set()
+    metrics.write(filename_metrics, config.metrics_textfile)
+    results.put({
+        "wall_time": time.monotonic() - start,
+        "import_time": import_time,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_workers_mb": max(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, peak_rss_workers()),
+        "metrics": metrics.summary(),
+    })
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = (len(values) - 1) * q
+    low = int(index)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+# Groups the requests recorded by the fakes by endpoint
+def summarize(records):
+    stages = {}
+    for endpoint in sorted({record[0] for record in records}):
+        stage_records = [record for record in records if record[0] == endpoint]
+        span = max(start + duration for _, start, duration, _, _ in stage_records) - min(start for _, start, _, _, _ in stage_records)
+        latencies = [duration * 1000 for _, _, duration, _, _ in stage_records]
+        received = sum(record[3] for record in stage_records)
+        sent = sum(record[4] for record in stage_records)
+        stages[endpoint] = {
+            "requests": len(stage_records),
+            "bytes_received": received,
+            "bytes_sent": sent,
+            "span_s": round(span, 3),
+            "requests_per_s": round(len(stage_records) / span, 1) if span else None,
+            "mb_per_s": round((received + sent) / 1024 / 1024 / span, 2) if span else None,
+            "latency_ms": {name: round(percentile(latencies, q), 2) for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))},
+        }
+    return stages
+
+
+def compare(report, baseline):
+    print(f"\nComparison with baseline ({baseline['scenario']}):")
+    for key in ("wall_time", "peak_rss_mb", "peak_rss_workers_mb"):
+        if baseline["run"].get(key):
+            print(f"  {key:<40} {baseline['run'][key]:>10.2f} -> {report['run'][key]:>10.2f} ({report['run'][key] / baseline['run'][key]:.2f}x)")
+    for endpoint, stage in report["stages"].items():
+        base = baseline["stages"].get(endpoint)
+        if base:
+            print(f"  {endpoint + ' requests':<40} {base['requests']:>10} -> {stage['requests']:>10}")
+            print(f"  {endpoint + ' p95 ms':<40} {base['latency_ms']['p95']:>10.2f} -> {stage['latency_ms']['p95']:>10.2f}")
+        else:
+            print(f"  {endpoint + ' requests':<40} {'-':>10} -> {stage['requests']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the Orthanc to DHIS2 pipeline against local fake servers")
+    parser.add_argument("--scenario", choices=sorted(fakes.SCENARIOS), default="small")
+    for scenario_field in fields(fakes.Scenario):
+        parser.add_argument("--" + scenario_field.name.replace("_", "-"), type=type(scenario_field.default), default=None,
+                            help=f"Override {scenario_field.name} of the scenario")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Option of credentials.ini for the pipeline")
+    parser.add_argument("--output", help="Write the report as JSON")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare with")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the logs, videos and state of the run")
+    args = parser.parse_args()
+
+    overrides = {f.name: getattr(args, f.name) for f in fields(fakes.Scenario) if getattr(args, f.name) is not None}
+    scenario = replace(fakes.SCENARIOS[args.scenario], **overrides)
+    settings = dict(option.split("=", 1) for option in args.set)
+    run_date = datetime.date.today()
+
+    print(f"Scenario {args.scenario}: {asdict(scenario)}")
+    orthanc, dhis2 = fakes.start_fakes(scenario, run_date)
+    workdir = tempfile.mkdtemp(prefix="ecopulmonar-benchmark-")
+    write_credentials(workdir, orthanc, dhis2, settings)
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_pipeline, args=(workdir, run_date, scenario.days, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        sys.exit(f"The pipeline failed (exit code {process.exitcode}). Logs in {workdir}/logs")
+
+    report = {
+        "scenario": args.scenario,
+        "parameters": asdict(scenario),
+        "settings": settings,
+        "run": results.get(),
+        "videos_attached": dhis2.attached,
+        "videos_expected": scenario.patients * min(scenario.instances, 5),
+        "stages": summarize(orthanc.log.records + dhis2.log.records),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+    if args.keep_workdir:
+        print(f"Workdir: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
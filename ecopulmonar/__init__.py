@@ -0,0 +1,3 @@
+# -*- coding: UTF-8 -*-
+
+# Interconexión para el intercambio de vídeos entre Orthanc y DHIS2. See cli.py for the commands
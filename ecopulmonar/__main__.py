@@ -0,0 +1,7 @@
+# -*- coding: UTF-8 -*-
+
+import sys
+
+from ecopulmonar.cli import main
+
+sys.exit(main())
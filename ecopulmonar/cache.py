@@ -0,0 +1,103 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Cache of the encoded videos in videos/, one <instance_id>.mp4 per instance with a <instance_id>.json that records the
+# Orthanc version of the instance it was encoded from. Videos are written to a temporary file and renamed when complete,
+# so a crashed encode never leaves a half-written mp4. When the cache grows over max_size the least recently used
+# videos, and the frames saved in images/, are removed by evict(). pinned() returns the instances whose videos are still
+# needed (e.g. not attached yet), which are never evicted. evict() is not called on commit: the process that records the
+# videos calls it, so pinned() already knows every committed video
+class VideoCache:
+    def __init__(self, directory, max_size, frames_directory="images", pinned=lambda: set()):
+        self.directory = directory
+        self.max_size = max_size
+        self.frames_directory = frames_directory
+        self.pinned = pinned
+
+    def video_path(self, instance_id):
+        return os.path.join(self.directory, instance_id + ".mp4")
+
+    def meta_path(self, instance_id):
+        return os.path.join(self.directory, instance_id + ".json")
+
+    # Path where the video is encoded before commit(). Keeps the .mp4 extension, as the writers choose the container by it
+    def partial_path(self, instance_id):
+        return os.path.join(self.directory, f".{instance_id}.{os.getpid()}.partial.mp4")
+
+    # Returns the path of the cached video if it was encoded from the same version of the instance, None otherwise
+    def get(self, instance_id, version):
+        try:
+            with open(self.meta_path(instance_id), encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta["version"] != version or os.path.getsize(self.video_path(instance_id)) != meta["size"]:
+                return None
+            os.utime(self.video_path(instance_id))  # Most recently used
+        except (OSError, ValueError, KeyError):
+            return None
+        return self.video_path(instance_id)
+
+    def commit(self, instance_id, version, partial_path):
+        os.replace(partial_path, self.video_path(instance_id))
+        meta_partial = self.meta_path(instance_id) + f".{os.getpid()}.partial"
+        with open(meta_partial, 'w', encoding='utf-8') as f:
+            json.dump({"version": version, "size": os.path.getsize(self.video_path(instance_id))}, f)
+        os.replace(meta_partial, self.meta_path(instance_id))
+        return self.video_path(instance_id)
+
+    def discard(self, partial_path):
+        try:
+            os.remove(partial_path)
+        except OSError:
+            pass
+
+    def entries(self):
+        entries = []  # (last use, size, instance_id, is frames directory)
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:  # Other workers may be removing files at the same time
+                if filename.endswith(".mp4") and not filename.startswith("."):
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), filename[:-len(".mp4")], False))
+                elif ".partial" in filename and os.path.getmtime(path) < time.time() - 24 * 3600:
+                    self.discard(path)  # Left by a crashed encode
+            except OSError:
+                continue
+        if os.path.isdir(self.frames_directory):
+            for instance_id in os.listdir(self.frames_directory):
+                path = os.path.join(self.frames_directory, instance_id)
+                try:
+                    if os.path.isdir(path):
+                        size = sum(os.path.getsize(os.path.join(path, filename)) for filename in os.listdir(path))
+                        entries.append((os.path.getmtime(path), size, instance_id, True))
+                except OSError:
+                    continue
+        return entries
+
+    def evict(self, keep=None):
+        entries = sorted(self.entries())
+        total = sum(size for last_use, size, instance_id, is_frames in entries)
+        if total <= self.max_size:
+            return
+        pinned = self.pinned()
+        for last_use, size, instance_id, is_frames in entries:
+            if total <= self.max_size:
+                break
+            if instance_id == keep or (not is_frames and instance_id in pinned):
+                continue
+            if is_frames:
+                shutil.rmtree(os.path.join(self.frames_directory, instance_id), ignore_errors=True)
+            else:
+                self.discard(self.meta_path(instance_id))
+                self.discard(self.video_path(instance_id))
+            total -= size
+            logger.info(f"Evicted {'frames' if is_frames else 'video'} of instance {instance_id} from the cache")
+        if total > self.max_size:
+            logger.warning(f"The cache holds {total / 1024 / 1024:.0f} MiB, over the {self.max_size / 1024 / 1024:.0f} MiB limit, in videos not attached yet")
+
@@ -0,0 +1,168 @@
+# -*- coding: UTF-8 -*-
+
+# Command line of the pipeline:
+#
+#   python -m ecopulmonar sync                         # last backfill_days dates, as the cron job
+#   python -m ecopulmonar sync --from 2024-03-01 --to 2024-03-31 --dry-run
+#   python -m ecopulmonar daemon
+#   python -m ecopulmonar encode <instance id>
+#   python -m ecopulmonar upload videos/<instance id>.mp4 --event <event uid> --data-element <DE uid>
+#   python -m ecopulmonar status
+#
+# The pipeline modules are imported by each command, so status and --help do not load requests, cv2 nor numpy
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+
+from ecopulmonar.config import Config, ConfigError
+
+logger = logging.getLogger(__name__)
+
+LOG_NAME = "main"
+
+
+# Logs to logs/<date>-<dhis2 server name>-main.log. Returns the filename of the metrics of the run, next to the log
+def setup_logging(config):
+    os.makedirs(config.log_directory, exist_ok=True)
+    filename_log = os.path.join(config.log_directory, datetime.date.today().strftime("%Y-%m-%d") + "-" + config.dhis2_server_name + "-" + LOG_NAME + ".log")
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(config.log_level.upper())
+    # create file handler which logs error messages
+    fh = logging.FileHandler(filename_log, encoding='utf-8')
+    fh.setLevel(config.log_level.upper())
+    # create formatter and add it to the handlers
+    fh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root_logger.addHandler(fh)
+    return filename_log.replace(".log", "-metrics.json")
+
+
+def write_metrics(config, filename_metrics):
+    from ecopulmonar.metrics import metrics
+    metrics.write(filename_metrics, config.metrics_textfile)
+
+
+def command_sync(config, args):
+    from ecopulmonar.pipeline import Pipeline
+
+    end_date = args.end_date or datetime.date.today()
+    start_date = args.start_date or end_date - datetime.timedelta(days=config.backfill_days - 1)
+    plan = Pipeline(config).sync(start_date, end_date, dry_run=args.dry_run)
+    if args.dry_run:
+        for row in plan:
+            stages = ", ".join(f"{instance}={stage}" for instance, stage in row["instances"].items())
+            print(f"{row['date']}  {row['event']}  {row['id_unico'] or '-':<20} {row['action']}" + (f"  [{stages}]" if stages else ""))
+        print(f"{sum(row['action'] == 'process' for row in plan)} of {len(plan)} events without video would be processed")
+    return 0
+
+
+def command_daemon(config, args):
+    from ecopulmonar.daemon import run_daemon
+    from ecopulmonar.pipeline import Pipeline
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    run_daemon(Pipeline(config), stop, lambda: write_metrics(config, args.filename_metrics))
+    return 0
+
+
+def command_encode(config, args):
+    from ecopulmonar.pipeline import Pipeline
+
+    video_path = Pipeline(config).generate_video(args.instance_id)
+    if not video_path:
+        print(f"No video generated for instance {args.instance_id}. See the log", file=sys.stderr)
+        return 1
+    print(video_path)
+    return 0
+
+
+def command_upload(config, args):
+    from ecopulmonar.pipeline import Pipeline
+
+    attached = Pipeline(config).uploader.send_video(args.event, None, args.filename, args.data_element)
+    if not attached:
+        print(f"{args.filename} was not added to event {args.event}. See the log", file=sys.stderr)
+        return 1
+    print(f"{args.filename} added to event {args.event} in DE {args.data_element}")
+    return 0
+
+
+def command_status(config, args):
+    from ecopulmonar.state import StateStore
+
+    if not os.path.isfile(config.state_db):
+        print(f"No state in {config.state_db}", file=sys.stderr)
+        return 1
+    print(json.dumps(StateStore(config.state_db).summary(), indent=2))
+    return 0
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date '{value}', expected YYYY-MM-DD") from None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="ecopulmonar", description="Uploads the ultrasound videos of Orthanc to the dhis2 events")
+    parser.add_argument("--config", default="credentials.ini", help="ini file with the [ecopulmonar] section (default: %(default)s)")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Option of the config, over the ini file and the ECOPULMONAR_<KEY> environment variables")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sync = subparsers.add_parser("sync", help="Process the ultrasound dates of a range that are not finished")
+    sync.add_argument("--from", dest="start_date", type=parse_date, help="First date (default: backfill_days before --to)")
+    sync.add_argument("--to", dest="end_date", type=parse_date, help="Last date (default: today)")
+    sync.add_argument("--dry-run", action="store_true", help="Resolve the events and studies and print what would be processed")
+    sync.set_defaults(function=command_sync)
+
+    daemon = subparsers.add_parser("daemon", help="Process each study when Orthanc marks it as stable, with a sweep every daemon_sweep_hours")
+    daemon.set_defaults(function=command_daemon)
+
+    encode = subparsers.add_parser("encode", help="Generate the video of an Orthanc instance and print its path")
+    encode.add_argument("instance_id")
+    encode.set_defaults(function=command_encode)
+
+    upload = subparsers.add_parser("upload", help="Upload a video and add it to a data element of an event")
+    upload.add_argument("filename")
+    upload.add_argument("--event", required=True, help="uid of the event")
+    upload.add_argument("--data-element", required=True, help="uid of the video DE")
+    upload.set_defaults(function=command_upload)
+
+    status = subparsers.add_parser("status", help="Print the progress recorded in the state store")
+    status.set_defaults(function=command_status, no_log=True)
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    try:
+        overrides = dict(option.split("=", 1) for option in args.set)
+    except ValueError:
+        parser.error("--set expects KEY=VALUE")
+    try:
+        config = Config.load(args.config, overrides=overrides)
+    except ConfigError as e:
+        parser.error(str(e))
+
+    if getattr(args, "no_log", False):
+        return args.function(config, args)
+    args.filename_metrics = setup_logging(config)
+    try:
+        return args.function(config, args)
+    except ConfigError as e:  # Missing options
+        logger.error(str(e))
+        print(e, file=sys.stderr)
+        return 2
+    finally:
+        write_metrics(config, args.filename_metrics)
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+
+# Options of the pipeline. Each one is read, by order of precedence, from the --set KEY=VALUE flags of the command line,
+# from an ECOPULMONAR_<KEY> environment variable and from the [ecopulmonar] section of credentials.ini
+
+import os
+from configparser import ConfigParser
+from dataclasses import dataclass, field, fields
+
+ENV_PREFIX = "ECOPULMONAR_"
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass
+class Config:
+    dhis2_server: str = ""
+    dhis2_server_name: str = ""
+    dhis2_user: str = ""
+    dhis2_password: str = ""
+    dhis2_page_size: int = 50
+    dhis2_max_workers: int = 4  # Pages requested in parallel
+    dhis2_max_url_length: int = 2000
+    orthanc_server: str = ""
+    orthanc_username: str = ""
+    orthanc_password: str = ""
+    orthanc_max_workers: int = 8  # Frames (or instance files) downloaded from Orthanc in parallel, over all the encode workers
+    orthanc_frame_retries: int = 3
+    orthanc_changes_limit: int = 100  # Changes requested to Orthanc at once
+    patient_workers: int = 4  # Patients in process at once: Orthanc lookups, waiting for their videos and queuing the upload
+    encode_workers: int = field(default_factory=os.cpu_count)  # Processes generating videos
+    upload_workers: int = 2  # Events uploading videos to dhis2 in parallel
+    upload_retries: int = 5
+    upload_timeout: float = 300  # Seconds without data from dhis2 before retrying
+    upload_backoff: float = 5  # Seconds before the first retry, doubled on each one
+    storage_poll_initial: float = 1  # Seconds between storage status requests
+    storage_poll_max: float = 15
+    storage_poll_timeout: float = 600  # Give up waiting for STORED
+    state_db: str = "state.sqlite"  # Progress of each instance between runs
+    state_day_settle: int = 7  # Days after which a finished date is not queried again
+    video_directory: str = "videos"
+    frames_directory: str = "images"
+    video_cache_max_mb: int = 2048  # Size of videos/ and images/ before evicting
+    encoder_backend: str = "opencv"  # opencv or ffmpeg
+    encoder_codec: str = ""  # FourCC for opencv (mp4v), ffmpeg encoder for ffmpeg (libx264)
+    encoder_crf: str = "23"  # Only ffmpeg
+    encoder_preset: str = "veryfast"  # Only ffmpeg
+    encoder_threads: int = 0  # 0: chosen by the encoder
+    encoder_fps: str = "auto"  # auto: from the FrameTime or CineRate of the instance
+    encoder_max_width: int = 0  # Downscale wider videos. 0: keep the size
+    ffmpeg_binary: str = "ffmpeg"
+    frame_source: str = "preview"  # preview: one rendered PNG per frame. file: download the DICOM file once and decode it
+    save_frames: bool = False  # Debug: keep a PNG copy of each frame in images/
+    log_directory: str = "logs"
+    log_level: str = "DEBUG"  # INFO skips formatting the debug payloads
+    metrics_textfile: str = ""  # Prometheus textfile with the metrics of the last run
+    daemon_poll_interval: float = 10  # Seconds between /changes requests once up to date
+    daemon_sweep_hours: float = 24  # Hours between reconciliation sweeps of the last backfill_days
+    backfill_days: int = 40  # Ultrasound dates processed on each sweep, from today backwards
+    min_number_frames: int = 30  # https://www.editalo.pro/videoedicion/fps/
+    program: str = "d6PLRyy8l9L"  # Programa de ecografía PEDIÁTRICO
+    program_stage: str = "yvhfP9fmA3W"
+    ou_root: str = "uDNvnDC9DHj"
+    de_patologia: str = "H2vzpa4ZFCf"
+    de_ultrasound_date: str = "aY2MfS8YVdd"
+    tea_id_unico: str = "ofdWjpgwzfe"
+    video_de_sin: list = field(default_factory=lambda: ["g33y4QmwHz7"])  # Video DE, in order, with patología 2
+    video_de_pat: list = field(default_factory=lambda: ["rXdrl3bPegQ", "uZAhzWxZ7Er", "SZHbLco7bNr", "DZCtmkLFDRQ", "H8yuwsOTmgY"])  # With patología 1
+
+    # Reads the options from the ini file (if it exists), the environment and the overrides, in increasing precedence
+    @classmethod
+    def load(cls, path="credentials.ini", section="ecopulmonar", overrides=None, environ=None):
+        environ = os.environ if environ is None else environ
+        names = {f.name for f in fields(cls)}
+        values = {}
+        parser = ConfigParser()
+        if parser.read(path, encoding="utf-8") and parser.has_section(section):
+            values.update((key, value) for key, value in parser.items(section) if key in names)
+        values.update((name, environ[ENV_PREFIX + name.upper()]) for name in names if ENV_PREFIX + name.upper() in environ)
+        for key, value in (overrides or {}).items():
+            if key not in names:
+                raise ConfigError(f"Unknown option '{key}'")
+            values[key] = value
+        return cls.from_strings(values)
+
+    @classmethod
+    def from_strings(cls, values):
+        options = {}
+        for f in fields(cls):
+            if f.name not in values:
+                continue
+            value = values[f.name]
+            kind = f.type
+            try:
+                if kind is bool:
+                    options[f.name] = value.strip().lower() in ("true", "yes", "1", "on")
+                elif kind is list:
+                    options[f.name] = [item.strip() for item in value.split(",") if item.strip()]
+                else:
+                    options[f.name] = kind(value)
+            except ValueError:
+                raise ConfigError(f"Invalid value '{value}' for option '{f.name}'") from None
+        return cls(**options)
+
+    # Raises ConfigError if any of the options is empty
+    def require(self, *names):
+        missing = [name for name in names if not getattr(self, name)]
+        if missing:
+            raise ConfigError(f"Missing options: {', '.join(missing)}. Set them in credentials.ini or as {ENV_PREFIX}<OPTION>")
+
+    # Ordered list of the uids of the video DE for the patología
+    def video_des(self, patologia):
+        if patologia == "2":
+            return self.video_de_sin
+        elif patologia == "1":
+            return self.video_de_pat
+        else:
+            return []
@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+
+# Daemon mode: the studies are processed as soon as Orthanc marks them as stable, instead of waiting for the next
+# sweep. The sweep still runs every daemon_sweep_hours to catch what the changes missed (e.g. an event entered in dhis2
+# after its study was stable)
+
+import logging
+import time
+from concurrent.futures import as_completed
+
+logger = logging.getLogger(__name__)
+
+ORTHANC_CHANGES_CURSOR = "orthanc_changes"
+STABLE_CHANGES = ("StableStudy", "StableSeries")
+
+
+# Follows the Orthanc changes until stop (a threading.Event) is set. write_metrics() is called after each batch of
+# changes with work and after each sweep
+def run_daemon(pipeline, stop, write_metrics=lambda: None):
+    config = pipeline.config
+    state = pipeline.state
+    orthanc = pipeline.orthanc
+    since = state.get_cursor(ORTHANC_CHANGES_CURSOR)
+    if since is None:
+        # The older studies are left to the first sweep
+        since = orthanc.get_last_change()
+        state.set_cursor(ORTHANC_CHANGES_CURSOR, since)
+    since = int(since)
+    logger.info(f"Daemon started. Following the Orthanc changes after {since}")
+    next_sweep = time.monotonic()
+
+    with pipeline.pools() as pools:
+        patient_pool, encode_pool, upload_pool = pools
+        while not stop.is_set():
+            if time.monotonic() >= next_sweep:
+                try:
+                    # The sweep runs in the pools of the daemon, which are idle meanwhile
+                    pipeline.sweep(pools)
+                except Exception:
+                    logger.exception("Error in the reconciliation sweep")
+                next_sweep = time.monotonic() + config.daemon_sweep_hours * 3600
+                write_metrics()
+
+            try:
+                changes = orthanc.get_changes(since)
+            except Exception:
+                logger.exception("Error reading the Orthanc changes")
+                stop.wait(config.daemon_poll_interval)
+                continue
+
+            # A study usually comes twice (StableSeries and StableStudy) and each patient is processed once per batch
+            patients = set()
+            for change in changes["Changes"]:
+                if change["ChangeType"] not in STABLE_CHANGES:
+                    continue
+                # A change that cannot be resolved (e.g. the study was deleted after it was stable) must not block the
+                # rest of the batch nor the cursor
+                try:
+                    patient = orthanc.get_change_patient(change)
+                except Exception:
+                    logger.exception(f"Error resolving the {change['ChangeType']} change {change.get('Seq')} of {change['ID']}. Left to the sweep")
+                    continue
+                if patient:
+                    patients.add(patient)
+
+            if patients:
+                logger.info(f"{len(patients)} stable studies in changes {since} to {changes['Last']}")
+                change_futures = {patient_pool.submit(pipeline.process_change, id_unico, study_date, encode_pool, upload_pool): id_unico
+                                  for id_unico, study_date in patients}
+                for future in as_completed(change_futures):
+                    try:
+                        future.result()
+                    except Exception:
+                        logger.exception(f"{change_futures[future]}: Error processing the patient. Left to the sweep")
+                write_metrics()
+
+            # Failed patients are not retried from the changes: the sweep takes care of them
+            since = changes["Last"]
+            state.set_cursor(ORTHANC_CHANGES_CURSOR, since)
+            if changes["Done"]:
+                stop.wait(config.daemon_poll_interval)
+    logger.info(f"Daemon stopped after change {since}")
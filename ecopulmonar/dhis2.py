@@ -0,0 +1,285 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from ecopulmonar.metrics import metrics
+from ecopulmonar.utils import map_ordered
+
+logger = logging.getLogger(__name__)
+
+EVENTS_FIELDS = "event,trackedEntityInstance,dataValues[*]"
+
+
+# Splits the uids in chunks whose semicolon-joined list is at most max_length characters
+def chunk_uids(uids, max_length):
+    chunks = []
+    chunk = []
+    length = 0
+    for uid in uids:
+        if chunk and length + 1 + len(uid) > max_length:
+            chunks.append(chunk)
+            chunk = []
+            length = 0
+        length += len(uid) + (1 if chunk else 0)
+        chunk.append(uid)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+# Event of the program stage without videos, with the data gathered along the pipeline
+@dataclass
+class Event:
+    uid: str
+    tei: str
+    patologia: str
+    id_unico: str = None
+    orthanc_patient: str = None
+    orthanc_study: str = None
+    orthanc_series: str = None
+    videos: list = field(default_factory=list)  # (instance_id, video_path) in instance order
+
+
+# Events indexed by uid, TEI and Id único. Built once per date and shared by all the stages of the pipeline
+class EventIndex:
+    def __init__(self):
+        self.by_uid = {}
+        self.by_tei = {}
+        self.by_id_unico = {}
+        self.tei_count = Counter()
+
+    def __len__(self):
+        return len(self.by_uid)
+
+    def __iter__(self):
+        return iter(self.by_uid.values())
+
+    def add(self, event):
+        self.by_uid[event.uid] = event
+        self.by_tei.setdefault(event.tei, event)
+        self.tei_count[event.tei] += 1
+
+    def set_id_unico(self, event, id_unico):
+        event.id_unico = id_unico
+        self.by_id_unico.setdefault(id_unico, event)
+
+    # TEIs with more than one event
+    def duplicated_teis(self):
+        return {tei for tei, count in self.tei_count.items() if count > 1}
+
+
+# Returns the EventIndex of the events without video and the list of uids of the events with video. An event with video
+# for which is_pending(event_uid) is true (e.g. only some of its videos were attached) is kept as without video, so it
+# is resumed
+def index_events(config, events, is_pending=lambda event_uid: False):
+    events_without_video = EventIndex()
+    events_with_video = []  # for debugging
+    for event in events:
+        event_uid = event["event"]
+        data_values = {dv["dataElement"]: dv["value"] for dv in event["dataValues"]}
+
+        # get patologia
+        patologia = data_values.get(config.de_patologia)
+        logger.debug("Event=%s Patologia=%s", event_uid, patologia)
+
+        if not patologia:
+            logger.error(f"Event {event_uid} without patology")
+            continue # go to the next event
+
+        video_des = config.video_des(patologia)
+        if video_des and video_des[0] in data_values and not is_pending(event_uid):  # UID of DE vídeo 1
+            events_with_video.append(event_uid)
+        else:
+            events_without_video.add(Event(uid=event_uid, tei=event["trackedEntityInstance"], patologia=patologia))
+    return events_without_video, events_with_video
+
+
+class DHIS2Client:
+    def __init__(self, config):
+        config.require("dhis2_server", "dhis2_user", "dhis2_password")
+        self.config = config
+        self.url = config.dhis2_server
+        # Keep-alive session shared by all the requests to dhis2: pages, uploads and storage polls
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(config.dhis2_user, config.dhis2_password)
+        pool_size = config.dhis2_max_workers + config.upload_workers * len(config.video_de_pat)
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    @property
+    def events_params(self):
+        return "program="+self.config.program+"&programStage="+self.config.program_stage+"&ou="+self.config.ou_root+"&ouMode=DESCENDANTS"
+
+    def get_page(self, url_resource):
+        logger.debug("%s", url_resource)
+        response = self.session.get(url_resource)
+        if not response.ok:
+            # If response code is not ok (200), print the resulting http error code with description
+            response.raise_for_status()
+        return response.json()
+
+    def get_resource_url(self, parent_resource, fields, page, param_filter=None, parameters=None):
+        url_resource = self.url + parent_resource + ".json?fields=" + fields + "&pageSize=" + str(self.config.dhis2_page_size) + "&format=json&totalPages=true&order=created:ASC&skipMeta=true&page=" + str(page)
+        if param_filter:
+            url_resource = url_resource + "&" + param_filter
+        if parameters:
+            url_resource = url_resource + "&" + parameters
+        return url_resource
+
+    # Yields the resources page by page. The first page gives the number of pages, and the rest are requested concurrently
+    def iter_resources(self, parent_resource, fields='*', param_filter=None, parameters=None):
+        def url_page(page):
+            return self.get_resource_url(parent_resource, fields, page, param_filter, parameters)
+
+        first_page = self.get_page(url_page(1))
+        yield from first_page[parent_resource]
+
+        pager = first_page.get("pager", {})  # No pager with paging=false
+        if "pageCount" in pager:
+            pages = [url_page(page) for page in range(2, int(pager["pageCount"]) + 1)]
+            with ThreadPoolExecutor(max_workers=self.config.dhis2_max_workers) as executor:
+                for response_page in map_ordered(executor, self.get_page, pages, self.config.dhis2_max_workers):
+                    yield from response_page[parent_resource]
+        else:
+            page = 1
+            response_page = first_page
+            while "nextPage" in response_page.get("pager", {}):
+                page += 1
+                response_page = self.get_page(url_page(page))
+                yield from response_page[parent_resource]
+
+    # Returns a dict with the tei uid as key and a dict {attribute uid: value} as value. The uids are requested in chunks
+    # that keep the URL under dhis2_max_url_length, in parallel
+    def get_tei_attributes(self, tei_uids):
+        tei_uids = list(tei_uids)
+        if not tei_uids:
+            return {}
+        fields = "trackedEntityInstance,attributes"
+        url_budget = self.config.dhis2_max_url_length - len(self.get_resource_url("trackedEntityInstances", fields, 1, parameters="trackedEntityInstance="))
+
+        def get_chunk(chunk):
+            # https://ecopulmonar.dhis2.ehas.org/api/trackedEntityInstances?trackedEntityInstance=gCgxGS7V57A;JaFZxFeJV0d
+            return list(self.iter_resources(parent_resource="trackedEntityInstances", fields=fields, parameters="trackedEntityInstance="+";".join(chunk)))
+
+        chunks = chunk_uids(tei_uids, url_budget)
+        tei_attributes = {}
+        with metrics.timer("dhis2_teis"), ThreadPoolExecutor(max_workers=self.config.dhis2_max_workers) as executor:
+            for teis in executor.map(get_chunk, chunks):
+                for tei in teis:
+                    tei_attributes[tei["trackedEntityInstance"]] = {dv["attribute"]: dv["value"] for dv in tei["attributes"]}
+        logger.info(f"Retrieved {len(tei_attributes)} of {len(tei_uids)} TEIs in {len(chunks)} requests")
+        metrics.count("teis", len(tei_attributes))
+
+        # Check that the amount requested is the same than retrieved
+        missing = [tei_uid for tei_uid in tei_uids if tei_uid not in tei_attributes]
+        if missing:
+            logger.error(f"{len(missing)} TEIs requested were not retrieved: {', '.join(missing)}")
+        return tei_attributes
+
+    # Returns the list of events of the ultrasound date
+    def get_events(self, ultrasound_date):
+        with metrics.timer("dhis2_events"):
+            events = list(self.iter_resources(parent_resource="events", fields=EVENTS_FIELDS, param_filter="filter="+self.config.de_ultrasound_date+":eq:"+ultrasound_date.strftime("%Y-%m-%d"),
+                                              parameters=self.events_params))
+        metrics.count("events", len(events))
+        return events
+
+    # Retrieves in a single query all the events with ultrasound date between start_date and end_date (both included).
+    # Returns a dict with the ultrasound date (YYYY-MM-DD) as key and the list of its events as value
+    def get_events_by_date(self, start_date, end_date):
+        date_filter = "filter="+self.config.de_ultrasound_date+":ge:"+start_date.strftime("%Y-%m-%d")+":le:"+end_date.strftime("%Y-%m-%d")
+        events_by_date = {}
+        n_events = 0
+        with metrics.timer("dhis2_events"):
+            for event in self.iter_resources(parent_resource="events", fields=EVENTS_FIELDS, param_filter=date_filter, parameters=self.events_params):
+                n_events += 1
+                for dv in event["dataValues"]:
+                    if dv["dataElement"] == self.config.de_ultrasound_date:
+                        events_by_date.setdefault(dv["value"][:10], []).append(event)
+        metrics.count("events", n_events)
+        logger.info(f"Retrieved {n_events} events for ultrasound dates from {start_date} to {end_date}")
+        return events_by_date
+
+    # Returns the events of the ultrasound date for the TEIs with the Id único
+    def get_patient_events(self, id_unico, ultrasound_date):
+        with metrics.timer("dhis2_events"):
+            teis = list(self.iter_resources(parent_resource="trackedEntityInstances", fields="trackedEntityInstance",
+                                            param_filter="filter="+self.config.tea_id_unico+":eq:"+id_unico,
+                                            parameters="program="+self.config.program+"&ou="+self.config.ou_root+"&ouMode=DESCENDANTS"))
+            events = []
+            for tei in teis:
+                events.extend(self.iter_resources(parent_resource="events", fields=EVENTS_FIELDS,
+                                                  param_filter="trackedEntityInstance="+tei["trackedEntityInstance"]+"&filter="+self.config.de_ultrasound_date+":eq:"+ultrasound_date.strftime("%Y-%m-%d"),
+                                                  parameters=self.events_params))
+        metrics.count("events", len(events))
+        return events
+
+    # Returns the storageStatus of the file resource: NONE, PENDING, FAILED or STORED
+    def get_storage_status(self, file_resource_uid):
+        url_resource = self.url + "fileResources/" + file_resource_uid
+        logger.debug("%s", url_resource)
+        response = self.session.get(url_resource)
+        if response.ok:
+            logger.debug("%s", response.text)
+            return response.json()["storageStatus"]
+        else:
+            # If response code is not ok (200), print the resulting http error code with description
+            response.raise_for_status()
+
+    # Polls the storage status of all the file resources together, calling on_stored(file_resource_uid) as soon as each
+    # one is STORED. The wait doubles while nothing changes, up to storage_poll_max. Returns the file resources that
+    # FAILED or were not stored before storage_poll_timeout
+    def wait_for_storage(self, file_resource_uids, on_stored):
+        with metrics.timer("storage_poll_wait"):
+            return self.poll_storage(file_resource_uids, on_stored)
+
+    def poll_storage(self, file_resource_uids, on_stored):
+        pending = list(file_resource_uids)
+        failed = []
+        delay = self.config.storage_poll_initial
+        deadline = time.monotonic() + self.config.storage_poll_timeout
+        while pending:
+            if time.monotonic() + delay > deadline:
+                logger.error(f"Timeout waiting for the storage of the file resources {pending}")
+                return failed + pending
+            time.sleep(delay)
+            logger.info(f"Requesting storage status of dhis2 file resources {pending}")
+            progress = False
+            for file_resource_uid in list(pending):
+                metrics.count("storage_polls")
+                status = self.get_storage_status(file_resource_uid)
+                if status == "STORED":
+                    logger.info(f"File Resource {file_resource_uid} Storage Status already STORAGED")
+                    pending.remove(file_resource_uid)
+                    on_stored(file_resource_uid)
+                    progress = True
+                elif status == "FAILED":
+                    logger.error(f"File Resource {file_resource_uid} Storage Status FAILED")
+                    pending.remove(file_resource_uid)
+                    failed.append(file_resource_uid)
+            delay = self.config.storage_poll_initial if progress else min(delay * 2, self.config.storage_poll_max)
+        return failed
+
+    def add_file_to_event(self, event_uid, de_uid, file_resource_uid):
+        url_resource = self.url + "events/"+event_uid+"/"+de_uid
+        logger.debug("%s", url_resource)
+        data = {"program": self.config.program,
+                "event": event_uid,
+                "dataValues": [{"dataElement": de_uid, "value": file_resource_uid}]
+                }
+        logger.debug("%s", data)
+        response = self.session.put(url_resource, json=data)
+        logger.debug("%s", response)
+        if response.ok:
+            logger.info(f"Updated event {event_uid}. Added DE {de_uid} with file resource {file_resource_uid}")
+        else:
+            # If response code is not ok (200), print the resulting http error code with description
+            response.raise_for_status()
@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+
+# Video encoders. Each one writes BGR frames to an mp4 file: write(frame) for each frame, then close(), or abort() to
+# give up. cv2 and numpy are imported when the first encoder is created
+
+import logging
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FPS = 30
+
+
+# Frames per second of the video: encoder_fps if set, otherwise the frame rate of the instance
+def get_video_fps(config, instance):
+    if config.encoder_fps != "auto":
+        return float(config.encoder_fps)
+    try:
+        if instance.frame_time and float(instance.frame_time) > 0:
+            return 1000.0 / float(instance.frame_time)
+        if instance.cine_rate and float(instance.cine_rate) > 0:
+            return float(instance.cine_rate)
+    except ValueError:
+        logger.warning(f"Instance '{instance.id}': invalid FrameTime '{instance.frame_time}' or CineRate '{instance.cine_rate}'")
+    return DEFAULT_FPS
+
+
+# Size (width, height) of the video for frames of the given size: at most encoder_max_width wide, and even, as required
+# by the yuv420p pixel format
+def get_video_size(config, size):
+    width, height = size
+    if config.encoder_max_width and width > config.encoder_max_width:
+        height = height * config.encoder_max_width / width
+        width = config.encoder_max_width
+    return int(width) // 2 * 2, int(round(height)) // 2 * 2
+
+
+class OpenCVEncoder:
+    def __init__(self, config, filename, fps, frame_size):
+        import cv2
+        self.cv2 = cv2
+        self.size = get_video_size(config, frame_size)
+        self.resize = self.size != tuple(frame_size)
+        if config.encoder_threads:
+            cv2.setNumThreads(config.encoder_threads)
+        codec = config.encoder_codec or 'mp4v'
+        # out = cv2.VideoWriter(filename='project.avi', fourcc=cv2.VideoWriter_fourcc(*'DIVX'), fps=30, frameSize=size)
+        self.out = cv2.VideoWriter(filename=filename, fourcc=cv2.VideoWriter_fourcc(*codec), fps=fps, frameSize=self.size)
+        if not self.out.isOpened():
+            raise RuntimeError(f"OpenCV cannot write '{filename}' with codec '{codec}'")
+
+    def write(self, frame):
+        if self.resize:
+            frame = self.cv2.resize(frame, self.size, interpolation=self.cv2.INTER_AREA)
+        self.out.write(frame)
+
+    def close(self):
+        self.out.release()
+
+
+# Pipes the raw BGR frames to an ffmpeg process, H.264 with CRF by default
+class FFmpegEncoder:
+    def __init__(self, config, filename, fps, frame_size):
+        import numpy as np
+        self.np = np
+        width, height = frame_size
+        command = [config.ffmpeg_binary, "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", f"{fps:.3f}", "-i", "-",
+                   "-c:v", config.encoder_codec or "libx264", "-preset", config.encoder_preset, "-crf", str(config.encoder_crf),
+                   "-threads", str(config.encoder_threads), "-pix_fmt", "yuv420p", "-movflags", "+faststart"]
+        video_size = get_video_size(config, frame_size)
+        if video_size != tuple(frame_size):
+            command += ["-vf", "scale=%d:%d" % video_size]
+        command += ["-f", "mp4", filename]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(self.np.ascontiguousarray(frame).tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        error = self.process.stderr.read()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed ({self.process.returncode}): {error.decode(errors='replace')}")
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+
+
+ENCODERS = {"opencv": OpenCVEncoder, "ffmpeg": FFmpegEncoder}
+
+
+# Identifies the encoding settings, so cached videos are encoded again when they change
+def get_encoder_settings(config):
+    return f"{config.encoder_backend}/{config.encoder_codec}/{config.encoder_crf}/{config.encoder_preset}/{config.encoder_fps}/{config.encoder_max_width}"
@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+
+# Decoding of the frames of an instance. numpy, cv2 and pydicom are imported on first use, so the commands that do not
+# encode videos start without them
+
+import logging
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+
+# True if pydicom>=3 can be imported. Only needed with frame_source=file
+def has_pydicom():
+    try:
+        import pydicom.pixels  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# Returns the (low, high) values that the windowing of pydicom maps the window to: the range of the Modality LUT, or the
+# range of the stored bits, signed with PixelRepresentation 1, after the rescale
+def get_window_range(ds):
+    if ds.get("ModalityLUTSequence"):
+        return 0, 2 ** int(ds.ModalityLUTSequence[0].LUTDescriptor[2]) - 1
+    bits_stored = int(ds.BitsStored)
+    if ds.get("PixelRepresentation", 0) == 0:
+        low, high = 0, 2 ** bits_stored - 1
+    else:
+        low, high = -2 ** (bits_stored - 1), 2 ** (bits_stored - 1) - 1
+    if ds.get("RescaleSlope") is not None and ds.get("RescaleIntercept") is not None:
+        slope, intercept = float(ds.RescaleSlope), float(ds.RescaleIntercept)
+        low, high = low * slope + intercept, high * slope + intercept
+    return low, high
+
+
+# Yields the BGR uint8 frames (height, width, 3) of the instance one at a time, so a long clip is never held in memory.
+# Returns None if the transfer syntax or the photometric interpretation cannot be decoded locally
+def decode_instance_frames(instance_id, dicom_content):
+    import numpy as np
+    from pydicom import Dataset
+    from pydicom.pixels import iter_pixels, apply_modality_lut, apply_voi_lut
+
+    ds = Dataset()
+    # YBR_* pixel data is returned already converted to RGB. The first frame is decoded here, so an unsupported
+    # transfer syntax falls back to the previews instead of failing in the middle of the encode
+    frames = iter_pixels(BytesIO(dicom_content), ds_out=ds)
+    try:
+        first_frame = next(frames)
+    except Exception as e:
+        logger.warning(f"Instance '{instance_id}': cannot decode transfer syntax {getattr(ds, 'file_meta', {}).get('TransferSyntaxUID')} locally: {e}")
+        return None
+    photometric = ds.get("PhotometricInterpretation", "")
+
+    if photometric in ("MONOCHROME1", "MONOCHROME2"):
+        def window(frame):
+            return apply_voi_lut(apply_modality_lut(frame, ds), ds)
+
+        if "WindowCenter" in ds and "VOILUTSequence" not in ds:
+            low, high = get_window_range(ds)
+        else:
+            # Same scale for all the frames of the clip, from a first pass that keeps only the range of each frame
+            ranges = [(values.min(), values.max()) for values in map(window, iter_pixels(BytesIO(dicom_content)))]
+            low, high = min(low for low, high in ranges), max(high for low, high in ranges)
+        scale = np.float32(255.0 / max(high - low, 1))
+
+        def convert(frame):
+            frame = ((window(frame).astype(np.float32) - low) * scale).clip(0, 255).astype(np.uint8)
+            if photometric == "MONOCHROME1":
+                frame = 255 - frame
+            return np.repeat(frame[..., np.newaxis], 3, axis=-1)
+    elif photometric in ("RGB", "YBR_FULL", "YBR_FULL_422", "YBR_ICT", "YBR_RCT"):
+        shift = int(ds.BitsStored) - 8
+
+        def convert(frame):
+            if frame.dtype != np.uint8:
+                frame = (frame >> shift).astype(np.uint8)
+            return np.ascontiguousarray(frame[..., ::-1])  # RGB to BGR, as expected by OpenCV
+    else:
+        logger.warning(f"Instance '{instance_id}': photometric interpretation '{photometric}' not supported locally")
+        return None
+
+    def converted_frames():
+        yield convert(first_frame)
+        for frame in frames:
+            yield convert(frame)
+    return converted_frames()
+
+
+# Yields the BGR frames of the instance in order, decoded locally or from the Orthanc previews
+def get_instance_frames(orthanc, instance_id, n_frames):
+    import cv2
+    import numpy as np
+
+    if orthanc.config.frame_source == "file":
+        if not has_pydicom():
+            logger.warning("frame_source=file requires pydicom>=3. Using the frame previews")
+        else:
+            frames = decode_instance_frames(instance_id, orthanc.download_instance_file(instance_id))
+            if frames is not None:
+                logger.info(f"Decoding locally the frames of instance {instance_id}")
+                return frames
+            logger.info(f"Instance '{instance_id}': falling back to the frame previews")
+
+    return (cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+            for content in orthanc.download_frames(instance_id, n_frames))
@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+# Timers and counters of the stages of a run. The seconds of a stage are added up over all the workers
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+        self.counters = Counter()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.monotonic()
+            self.stages.clear()
+            self.counters.clear()
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            self.stages[stage]["calls"] += calls
+            self.stages[stage]["seconds"] += seconds
+            self.stages[stage]["max_seconds"] = max(self.stages[stage]["max_seconds"], seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.monotonic() - start)
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {"stages": {stage: dict(values) for stage, values in self.stages.items()}, "counters": dict(self.counters)}
+
+    # Adds the snapshot of the metrics of a worker process
+    def merge(self, snapshot):
+        for stage, values in snapshot["stages"].items():
+            with self.lock:
+                self.stages[stage]["calls"] += values["calls"]
+                self.stages[stage]["seconds"] += values["seconds"]
+                self.stages[stage]["max_seconds"] = max(self.stages[stage]["max_seconds"], values["max_seconds"])
+        for counter, value in snapshot["counters"].items():
+            self.count(counter, value)
+
+    def summary(self):
+        summary = self.snapshot()
+        summary["run_seconds"] = time.monotonic() - self.start
+        stages, counters = summary["stages"], summary["counters"]
+        rates = {}
+        for rate, counter, stage in (("frames_downloaded_per_second", "frames_downloaded", "frame_download"),
+                                     ("frame_download_bytes_per_second", "frame_download_bytes", "frame_download"),
+                                     ("frames_encoded_per_second", "frames_encoded", "encode"),
+                                     ("upload_bytes_per_second", "upload_bytes", "upload")):
+            if counters.get(counter) and stages.get(stage, {}).get("seconds"):
+                rates[rate] = counters[counter] / stages[stage]["seconds"]
+        summary["rates"] = rates
+        return summary
+
+    # Writes the summary as JSON and, if textfile is given, in the Prometheus textfile format
+    def write(self, filename, textfile=None):
+        summary = self.summary()
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        if textfile:
+            lines = [f"ecopulmonar_run_seconds {summary['run_seconds']:.3f}"]
+            for stage, values in sorted(summary["stages"].items()):
+                lines.append(f'ecopulmonar_stage_calls_total{{stage="{stage}"}} {values["calls"]}')
+                lines.append(f'ecopulmonar_stage_seconds_total{{stage="{stage}"}} {values["seconds"]:.3f}')
+                lines.append(f'ecopulmonar_stage_max_seconds{{stage="{stage}"}} {values["max_seconds"]:.3f}')
+            for counter, value in sorted(summary["counters"].items()):
+                lines.append(f"ecopulmonar_{counter}_total {value}")
+            for rate, value in sorted(summary["rates"].items()):
+                lines.append(f"ecopulmonar_{rate} {value:.3f}")
+            # The textfile collector may read it at any time, so it is replaced atomically
+            with open(textfile + ".partial", 'w', encoding='utf-8') as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(textfile + ".partial", textfile)
+        logger.info(f"Metrics of the run written to {filename}")
+
+
+
+# Metrics of the current process. Worker processes reset it for each task and send a snapshot back to the parent
+metrics = Metrics()
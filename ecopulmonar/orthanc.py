@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+
+import datetime
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from ecopulmonar.metrics import metrics
+from ecopulmonar.utils import map_ordered
+
+logger = logging.getLogger(__name__)
+
+
+# Instance of Orthanc with the data needed to generate its video
+@dataclass
+class OrthancInstance:
+    id: str
+    number_frames: int
+    file_uuid: str
+    frame_time: str = None  # FrameTime (0018,1063), in ms
+    cine_rate: str = None  # CineRate (0018,0040), in frames per second
+
+
+# Study of the date in Orthanc. series: dict with the series id as key and the list of OrthancInstance of the series,
+# in the order of Orthanc, as value
+@dataclass
+class OrthancStudy:
+    id: str
+    patient: str
+    series: dict
+
+
+# download_slots is the semaphore that bounds the frame and file downloads in flight. The encode workers share one
+# across processes, so Orthanc sees at most orthanc_max_workers downloads whatever the number of workers
+class OrthancClient:
+    def __init__(self, config, download_slots=None):
+        config.require("orthanc_server", "orthanc_username", "orthanc_password")
+        self.config = config
+        self.url = config.orthanc_server
+        if download_slots is None:
+            download_slots = threading.BoundedSemaphore(config.orthanc_max_workers)
+        self.download_slots = download_slots
+        # Keep-alive session shared by all the requests to Orthanc. The pool is sized to the number of parallel downloads.
+        # Worker processes create their own client, so they never reuse the connections of the parent process
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(config.orthanc_username, config.orthanc_password)
+        pool_size = config.orthanc_max_workers
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    # Returns the JSON of the resource (e.g. "studies", study id)
+    def get_resource(self, level, resource_id):
+        response = self.session.get(self.url+"/"+level+"/"+resource_id)
+        if not response.ok:
+            # If response code is not ok (200), print the resulting http error code with description
+            response.raise_for_status()
+        return response.json()
+
+    def get_instance_info(self, instance_id):
+        return self.get_resource("instances", instance_id)
+
+    # Returns the value of the tag (group-element) of the instance, or None if the instance does not contain it
+    def get_instance_tag(self, instance_id, tag):
+        url = self.url+"/instances/"+instance_id+"/content/"+tag
+        response = self.session.get(url)
+        if response.status_code == 404:
+            return None
+        if not response.ok:
+            # If response code is not ok (200), print the resulting http error code with description
+            response.raise_for_status()
+        return response.text.strip("\x00 ")
+
+    def get_instance(self, instance_id):
+        instance_info = self.get_instance_info(instance_id)
+        # If there are no number of frames, it is 0
+        return OrthancInstance(id=instance_id,
+                               number_frames=int(instance_info["MainDicomTags"].get("NumberOfFrames", 0)),
+                               file_uuid=instance_info["FileUuid"],
+                               frame_time=self.get_instance_tag(instance_id, "0018-1063"),
+                               cine_rate=self.get_instance_tag(instance_id, "0018-0040"))
+
+    # Returns the PNG content of the frame. Each frame is retried on its own before giving up
+    def download_frame(self, instance_id, frame_int):
+        url = self.url+"/instances/"+instance_id+"/frames/"+str(frame_int)+"/preview"
+        retries = self.config.orthanc_frame_retries
+        for attempt in range(1, retries + 1):
+            try:
+                with self.download_slots:
+                    response = self.session.get(url)
+                # If response code is not ok (200), print the resulting http error code with description
+                response.raise_for_status()
+                metrics.count("frame_download_bytes", len(response.content))
+                return response.content
+            except requests.exceptions.RequestException as e:
+                if attempt == retries:
+                    raise
+                metrics.count("frame_download_retries")
+                logger.warning(f"Frame {frame_int} of instance {instance_id} failed (attempt {attempt}/{retries}): {e}")
+                time.sleep(attempt)
+
+    # Yields the PNG content of each frame in frame order as soon as it is available. Only a bounded window of frames is
+    # downloaded ahead, so memory does not grow with the number of frames
+    def download_frames(self, instance_id, n_frames):
+        logger.info(f"Downloading {n_frames} frames from instance {instance_id}")
+        path = os.path.join(self.config.frames_directory, instance_id)
+        if self.config.save_frames:
+            try:
+                os.makedirs(path)
+            except OSError:
+                logger.debug("Creation of the directory %s failed", path)
+            else:
+                logger.debug("Successfully created the directory %s ", path)
+
+        workers = self.config.orthanc_max_workers
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            frames = map_ordered(executor, lambda frame_int: self.download_frame(instance_id, frame_int), range(0, int(n_frames)), 2 * workers)
+            for frame_int, content in enumerate(frames):
+                if self.config.save_frames:
+                    filename = os.path.join(path, str(frame_int)+".png")
+                    with open(filename, 'wb') as f:
+                        f.write(content)
+                        logger.debug("Saved %s", filename)
+                yield content
+
+    def download_instance_file(self, instance_id):
+        url = self.url+"/instances/"+instance_id+"/file"
+        with self.download_slots, metrics.timer("instance_file_download"):
+            response = self.session.get(url)
+        # If response code is not ok (200), print the resulting http error code with description
+        response.raise_for_status()
+        metrics.count("frame_download_bytes", len(response.content))
+        return response.content
+
+    def find(self, level, study_date, requested_tags=None, patient_id=None):
+        data = {
+            "Level": level,
+            "Expand": True,
+            "Query": {
+                'StudyDate': study_date.strftime("%Y%m%d")
+            }
+        }
+        if patient_id:
+            data["Query"]["PatientID"] = patient_id
+        if requested_tags:
+            data["RequestedTags"] = requested_tags
+        with metrics.timer("orthanc_find"):
+            response = self.session.post(self.url+"/tools/find", json=data)
+        if not response.ok:
+            # If response code is not ok (200), print the resulting http error code with description
+            response.raise_for_status()
+        return response.json()
+
+    # Returns a dict with the PatientID (Id único) as key and the list of its OrthancStudy of the date as value. Three
+    # /tools/find requests resolve all the studies, series and instances of the date, or only those of patient_id
+    def get_studies(self, study_date, patient_id=None):
+        logger.info(f"Requesting the studies of date {study_date.strftime('%Y%m%d')} in orthanc server")
+        instances = {}
+        for instance in self.find("Instance", study_date, requested_tags=["NumberOfFrames", "FrameTime", "CineRate"], patient_id=patient_id):
+            tags = dict(instance["MainDicomTags"], **instance.get("RequestedTags", {}))
+            # If there are no number of frames, it is 0
+            instances[instance["ID"]] = OrthancInstance(id=instance["ID"], number_frames=int(tags.get("NumberOfFrames", 0)), file_uuid=instance.get("FileUuid"),
+                                                        frame_time=tags.get("FrameTime"), cine_rate=tags.get("CineRate"))
+        series_instances = {series["ID"]: series["Instances"] for series in self.find("Series", study_date, patient_id=patient_id)}
+
+        studies = {}
+        for study in self.find("Study", study_date, patient_id=patient_id):
+            series = {series_id: [instances.get(instance_id) or self.get_instance(instance_id) for instance_id in series_instances.get(series_id, [])]
+                      for series_id in study["Series"]}
+            study_patient_id = study["PatientMainDicomTags"].get("PatientID")
+            studies.setdefault(study_patient_id, []).append(OrthancStudy(id=study["ID"], patient=study["ParentPatient"], series=series))
+        logger.info(f"Retrieved {sum(len(patient_studies) for patient_studies in studies.values())} studies of {len(studies)} patients, with {len(instances)} instances, for date {study_date.strftime('%Y%m%d')}")
+        return studies
+
+    # Returns the response of /changes: the changes after since (at most orthanc_changes_limit), the sequence number of
+    # the last one (Last) and whether there are no more changes (Done)
+    def get_changes(self, since):
+        response = self.session.get(self.url+"/changes", params={"since": since, "limit": self.config.orthanc_changes_limit})
+        if not response.ok:
+            # If response code is not ok (200), print the resulting http error code with description
+            response.raise_for_status()
+        return response.json()
+
+    # Sequence number of the last change in Orthanc
+    def get_last_change(self):
+        response = self.session.get(self.url+"/changes", params={"last": ""})
+        if not response.ok:
+            # If response code is not ok (200), print the resulting http error code with description
+            response.raise_for_status()
+        return response.json()["Last"]
+
+    # Returns the (PatientID, study date) of the study of a StableStudy or StableSeries change, or None if it does not
+    # identify a patient
+    def get_change_patient(self, change):
+        if change["ChangeType"] == "StableSeries":
+            study_id = self.get_resource("series", change["ID"])["ParentStudy"]
+        else:
+            study_id = change["ID"]
+        study = self.get_resource("studies", study_id)
+        patient_id = study["PatientMainDicomTags"].get("PatientID")
+        study_date = study["MainDicomTags"].get("StudyDate")
+        if not patient_id or not study_date:
+            logger.warning(f"Study {study_id} without PatientID or StudyDate. Left to the sweep")
+            return None
+        return patient_id, datetime.datetime.strptime(study_date, "%Y%m%d").date()
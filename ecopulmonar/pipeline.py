@@ -0,0 +1,435 @@
+# -*- coding: UTF-8 -*-
+
+import datetime
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from datetime import date
+from functools import cached_property
+
+from ecopulmonar.cache import VideoCache
+from ecopulmonar.encoders import ENCODERS, get_encoder_settings, get_video_fps
+from ecopulmonar.frames import get_instance_frames
+from ecopulmonar.metrics import metrics
+from ecopulmonar.state import StateStore, file_checksum, is_video_valid
+
+logger = logging.getLogger(__name__)
+
+
+# Pipeline from the events of dhis2 to the videos attached to them. The clients, the state store and the cache are
+# created on first use, so a worker process that only encodes never connects to dhis2 nor opens the state store: the
+# parent records the videos and evicts the cache.
+# orthanc_slots: the semaphore of the Orthanc downloads shared by the encode workers (see OrthancClient)
+class Pipeline:
+    def __init__(self, config, orthanc_slots=None):
+        self.config = config
+        self.orthanc_slots = orthanc_slots
+        # Instances submitted to the encode pool whose video is not recorded in the state store yet
+        self.encoding = set()
+        self.encoding_lock = threading.Lock()
+
+    @cached_property
+    def dhis2(self):
+        from ecopulmonar.dhis2 import DHIS2Client
+        return DHIS2Client(self.config)
+
+    @cached_property
+    def orthanc(self):
+        from ecopulmonar.orthanc import OrthancClient
+        return OrthancClient(self.config, self.orthanc_slots)
+
+    @cached_property
+    def state(self):
+        return StateStore(self.config.state_db)
+
+    @cached_property
+    def video_cache(self):
+        os.makedirs(self.config.video_directory, exist_ok=True)
+        return VideoCache(self.config.video_directory, self.config.video_cache_max_mb * 1024 * 1024, self.config.frames_directory,
+                          pinned=self.pinned_instances)
+
+    # Instances whose video must stay in the cache: being encoded, or recorded and not attached yet. The encoding set is
+    # read first, so an instance that is recorded meanwhile is still in one of both
+    def pinned_instances(self):
+        with self.encoding_lock:
+            encoding = set(self.encoding)
+        return encoding | self.state.unattached_instances()
+
+    @cached_property
+    def uploader(self):
+        from ecopulmonar.uploads import Uploader
+        return Uploader(self.config, self.dhis2, self.state)
+
+    # Patients, encoding and uploads run in separate pools so that one slow patient does not block the rest. The frames
+    # are downloaded by the encode workers, which share orthanc_max_workers download slots.
+    # The encode workers are started on demand from the patient pool threads, so they come from a forkserver: a fork of
+    # this process could copy a lock (e.g. of the metrics or of a log handler) held by another thread and deadlock
+    @contextmanager
+    def pools(self):
+        root_logger = logging.getLogger()
+        log_handlers = [(handler.baseFilename, handler.level, handler.formatter)
+                        for handler in root_logger.handlers if isinstance(handler, logging.FileHandler)]
+        context = multiprocessing.get_context("forkserver")
+        orthanc_slots = context.BoundedSemaphore(self.config.orthanc_max_workers)
+        with ThreadPoolExecutor(max_workers=self.config.patient_workers) as patient_pool, \
+                ProcessPoolExecutor(max_workers=self.config.encode_workers, mp_context=context, initializer=init_worker,
+                                    initargs=(self.config, orthanc_slots, log_handlers, root_logger.level)) as encode_pool, \
+                ThreadPoolExecutor(max_workers=self.config.upload_workers) as upload_pool:
+            yield patient_pool, encode_pool, upload_pool
+
+    # Returns the filename_video or None if no frames. The instance data (number of frames, FileUuid and frame rate) is
+    # requested to Orthanc if not given. A video cached for the same FileUuid and encoder settings is not generated again
+    def generate_video(self, instance_id, instance=None):
+        config = self.config
+        logger.debug("Generating video for instance %s", instance_id)
+        if instance is None:
+            instance = self.orthanc.get_instance(instance_id)
+        number_frames = instance.number_frames
+        if number_frames == 0:
+            logger.error(f"Instance '{instance_id}' contains no frames")
+            return None
+        elif number_frames < config.min_number_frames:
+            logger.error(f"Instance '{instance_id}' contains {number_frames} frames, less than the minimun ({config.min_number_frames})")
+            return None
+        logger.debug("%s. Number of frames: %s", instance_id, number_frames)
+
+        version = f"{instance.file_uuid}/{number_frames}/{get_encoder_settings(config)}"
+        filename_video = self.video_cache.get(instance_id, version)
+        if filename_video:
+            logger.info(f"Video {filename_video} for instance {instance_id} found in the cache")
+            metrics.count("video_cache_hits")
+            return filename_video
+
+        logger.debug("Start video processing")
+        fps = get_video_fps(config, instance)
+        partial_video = self.video_cache.partial_path(instance_id)
+        out = None
+        encoded_frames = 0
+        encode_time = 0.0
+        start_time = time.monotonic()
+        try:
+            # Each frame is decoded in memory and written to the encoder as soon as it arrives
+            for img in get_instance_frames(self.orthanc, instance_id, number_frames):
+                encode_start = time.monotonic()
+                if out is None:
+                    height, width, layers = img.shape
+                    out = ENCODERS[config.encoder_backend](config, partial_video, fps, (width, height))
+                out.write(img)
+                encode_time += time.monotonic() - encode_start
+                encoded_frames += 1
+            encode_start = time.monotonic()
+            out.close()
+            encode_time += time.monotonic() - encode_start
+        except BaseException:
+            if hasattr(out, "abort"):
+                out.abort()
+            self.video_cache.discard(partial_video)
+            raise
+        filename_video = self.video_cache.commit(instance_id, version, partial_video)
+        logger.debug("Finish video processing")
+        video_size = os.path.getsize(filename_video)
+        # The frames arrive while encoding: the rest of the time of the loop is spent downloading and decoding them
+        metrics.add_time("frame_download", time.monotonic() - start_time - encode_time)
+        metrics.count("frames_downloaded", encoded_frames)
+        metrics.add_time("encode", encode_time)
+        metrics.count("frames_encoded", encoded_frames)
+        metrics.count("video_bytes", video_size)
+        logger.info(f"Generated video {filename_video} for instance {instance_id}: {encoded_frames} frames at {fps:.1f} fps, "
+                    f"{video_size / 1024:.0f} KiB, encoded in {encode_time:.2f}s ({encoded_frames / max(encode_time, 1e-6):.0f} frames/s, "
+                    f"{encoded_frames / fps / max(encode_time, 1e-6):.1f}x realtime), {time.monotonic() - start_time:.2f}s in total")
+
+        return filename_video
+
+    # Checks that the patient has exactly one study with one series in the date, and no more instances than video DE.
+    # Returns the list of OrthancInstance of the series, or None if the videos of the event cannot be generated
+    # studies: the Orthanc studies of the patient in the study date, from OrthancClient.get_studies
+    def resolve_patient(self, event, study_date, studies):
+        id_unico = event.id_unico
+        if not studies:  # No study in the index of the date
+            logger.info(f"No Study for patient {id_unico} and date {study_date}")
+            return None
+
+        if len(studies) != 1:  # More than one study in the very same date
+            logger.error(f"Retrieved more than one study for Id Único {id_unico} in {study_date.strftime('%Y%m%d')}'. Result: {[study.id for study in studies]} ")
+            return None
+        study = studies[0]
+
+        if len(study.series) != 1:  # More than one series in the same study
+            logger.error(f"Retrieved more than one series in study {study.id} for Id Único {id_unico} in {study_date.strftime('%Y%m%d')}'. Result: {list(study.series)} ")
+            return None
+
+        series_id, instances = next(iter(study.series.items()))
+        event.orthanc_patient = study.patient
+        event.orthanc_study = study.id
+        event.orthanc_series = series_id
+        logger.debug("%s", event)
+
+        if not instances:  # There are no instances
+            return None
+
+        logger.info(f"Retrieved for Id Único {id_unico} and Series {series_id} from study {study.id} associated to event_id {event.uid} a total number of {len(instances)} instances.")
+
+        # Check if it is the number of instances expected
+        max_videos = len(self.config.video_des(event.patologia))
+        if len(instances) > max_videos:
+            logger.error(f'Event ({event.uid}). The number of videos ({len(instances)}) are different than expected ({max_videos})')
+            return None
+        return instances
+
+    # Looks for the study of the patient in Orthanc and generates its videos. Returns the future of the upload of the
+    # videos to dhis2, or None if there is nothing to upload
+    def process_patient(self, id_unico, study_date, studies, events_without_video, encode_pool, upload_pool):
+        event = events_without_video.by_id_unico[id_unico]
+        event_uid = event.uid
+        if self.state.is_event_finished(event_uid):
+            logger.info(f"{id_unico}: All the videos of event ({event_uid}) were attached in a previous run")
+            return None
+
+        instances = self.resolve_patient(event, study_date, studies)
+        if not instances:
+            return None
+
+        # Encoding runs in the process pool. The results are collected in instance order to keep the order of the videos
+        video_futures = []
+        for idx_instances, orthanc_instance in enumerate(instances):
+            instance = orthanc_instance.id
+            record = self.state.get_instance(instance)
+            if record and (record["stage"] != "generated" or is_video_valid(record)):
+                logger.info(f"Instance {instance} of id único {id_unico} resumed from stage '{record['stage']}'")
+                video_futures.append((instance, None))
+            else:
+                logger.info(f"Generating video {idx_instances+1} for instance {instance} and id único {id_unico}")
+                with self.encoding_lock:
+                    self.encoding.add(instance)
+                video_futures.append((instance, encode_pool.submit(generate_video_in_worker, instance, orthanc_instance)))
+        try:
+            for instance, video_future in video_futures:
+                if video_future is None:
+                    event.videos.append((instance, self.state.get_instance(instance)["video_path"]))
+                    continue
+                video_path, worker_metrics = video_future.result()
+                metrics.merge(worker_metrics)
+                if video_path:  # videopath could be None if an error occur
+                    self.state.save_video(instance, event_uid, video_path, file_checksum(video_path))
+                    event.videos.append((instance, video_path))
+        finally:
+            with self.encoding_lock:
+                self.encoding.difference_update(instance for instance, video_future in video_futures)
+        # The new videos are recorded, so the eviction keeps them until they are attached
+        self.video_cache.evict()
+
+        logger.info(f'{id_unico}: Generated {len(event.videos)} videos for event ({event_uid})')
+
+        logger.debug("%s", event.videos)
+        max_videos = len(self.config.video_des(event.patologia))
+        if len(event.videos) > max_videos:
+            logger.warning(f"Generated more videos ({len(event.videos)}) than Video DE ({max_videos}). Uploading only the first {max_videos}")
+            event.videos = event.videos[:max_videos]
+
+        if not event.videos:
+            return None
+        return upload_pool.submit(self.uploader.upload_event_videos, event_uid, id_unico, event.patologia, list(event.videos))
+
+    # Returns the EventIndex of the events without video of the date, with their Id único, or None if there are none.
+    # events: list of events of the ultrasound date, if already retrieved with DHIS2Client.get_events_by_date
+    def get_events_without_video(self, ultrasound_date, events=None):
+        from ecopulmonar.dhis2 import index_events
+
+        ultrasound_date_dhis2 = ultrasound_date.strftime("%Y-%m-%d")
+        # Get all events without videos uploaded
+        if events is None:
+            events = self.dhis2.get_events(ultrasound_date)
+        events_without_video, events_with_video = index_events(self.config, events, self.state.has_pending_instances)
+
+        logger.info(f"Retrieved {len(events)} events for ultrasound date {ultrasound_date_dhis2}")
+        metrics.count("events_without_video", len(events_without_video))
+        logger.debug("%s", events_without_video.by_uid)
+        logger.info(f"{len(events_with_video)} events with video: {', '.join(events_with_video)}")
+        logger.info(f"{len(events_without_video)} events without video: {', '.join(events_without_video.by_uid)}")
+
+        teis_without_video = set(events_without_video.by_tei)
+        logger.info(f"TEIs without video {teis_without_video}")
+
+        if not events_without_video:
+            return None
+
+        # Revisar que no hay ningun duplicado. Si hay duplicado, eliminar la TEI
+        teis_duplicated = events_without_video.duplicated_teis()
+
+        if teis_duplicated:
+            logger.error(f"There are TEIs with more than one event: {teis_duplicated}")
+            teis_without_video = teis_without_video - teis_duplicated
+            logger.info(f"Removed duplicates: {teis_duplicated}")
+            logger.info(f"TEIs without video {teis_without_video}")
+
+        tei_attributes = self.dhis2.get_tei_attributes(teis_without_video)
+
+        # Get TEA 'id_único' (ofdWjpgwzfe) for each tei in teis_without_video
+        for tei_uid, attributes in tei_attributes.items():
+            if self.config.tea_id_unico in attributes:
+                id_unico = attributes[self.config.tea_id_unico]
+                event = events_without_video.by_tei[tei_uid]
+                events_without_video.set_id_unico(event, id_unico)
+                logger.info(f"Id único '{id_unico}' for TEI '{tei_uid}' from event '{event.uid}'")
+            else:
+                logger.warning(f"TEI '{tei_uid}' does not contain a TEA 'Id único'")
+
+        logger.debug("%s", events_without_video.by_uid)
+        logger.info(f"List of Id Únicos retrieved: {set(events_without_video.by_id_unico)}")
+        return events_without_video
+
+    # Processes the events without video of the ultrasound date
+    # pools: the (patient_pool, encode_pool, upload_pool) of Pipeline.pools, shared by all the dates of the run
+    # events: list of events of the ultrasound date, if already retrieved with DHIS2Client.get_events_by_date
+    def run_date(self, ultrasound_date, pools, events=None):
+        ultrasound_date_dhis2 = ultrasound_date.strftime("%Y-%m-%d")
+
+        logger.info("-------------------------------------------")
+        logger.info(f"Constants: Program {self.config.program}. Minimum of frames: {self.config.min_number_frames}.")
+        logger.info(f"Starting the process for ultrasound date {ultrasound_date_dhis2}")
+
+        events_without_video = self.get_events_without_video(ultrasound_date, events)
+        if not events_without_video:
+            logger.info(f"There is no events without video. Skip the process.")
+            logger.info("-------------------------------------------")
+            if (date.today() - ultrasound_date).days >= self.config.state_day_settle:
+                self.state.finish_day(ultrasound_date)
+            return None
+
+        orthanc_studies = self.orthanc.get_studies(ultrasound_date)
+
+        # Retrieve information per patient
+        patient_pool, encode_pool, upload_pool = pools
+        patient_futures = {patient_pool.submit(self.process_patient, id_unico, ultrasound_date, orthanc_studies.get(id_unico, []), events_without_video, encode_pool, upload_pool): id_unico
+                           for id_unico in events_without_video.by_id_unico}
+        upload_futures = {}
+        for future in as_completed(patient_futures):
+            id_unico = patient_futures[future]
+            try:
+                upload_future = future.result()
+            except Exception:
+                logger.exception(f"{id_unico}: Error processing the patient")
+                continue
+            if upload_future:
+                upload_futures[upload_future] = id_unico
+        for future in as_completed(upload_futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception(f"{upload_futures[future]}: Error uploading the videos")
+
+        # Once the data entry has settled, a date whose events are all finished is not processed again
+        if (date.today() - ultrasound_date).days >= self.config.state_day_settle and all(self.state.is_event_finished(event.uid) for event in events_without_video):
+            self.state.finish_day(ultrasound_date)
+        logger.info(f"Finished the process for ultrasound date {ultrasound_date_dhis2}")
+        logger.info("-------------------------------------------")
+
+    # Returns what run_date would do for each event without video of the date, without encoding nor uploading: a list
+    # of dicts with the event, its Id único and the stage of each of its instances ("new" if not started)
+    def plan_date(self, ultrasound_date, events=None):
+        events_without_video = self.get_events_without_video(ultrasound_date, events)
+        if not events_without_video:
+            return []
+        orthanc_studies = self.orthanc.get_studies(ultrasound_date)
+        plan = []
+        for event in events_without_video:
+            row = {"date": ultrasound_date.isoformat(), "event": event.uid, "id_unico": event.id_unico, "instances": {}}
+            if event.id_unico is None:
+                row["action"] = "skip: no Id único"
+            elif self.state.is_event_finished(event.uid):
+                row["action"] = "skip: attached in a previous run"
+            else:
+                instances = self.resolve_patient(event, ultrasound_date, orthanc_studies.get(event.id_unico, []))
+                if not instances:
+                    row["action"] = "skip: no valid study (see the log)"
+                else:
+                    for instance in instances:
+                        record = self.state.get_instance(instance.id)
+                        row["instances"][instance.id] = record["stage"] if record else "new"
+                    row["action"] = "process"
+            plan.append(row)
+        return plan
+
+    # Ultrasound dates from end_date back to start_date that are not finished
+    def pending_dates(self, start_date, end_date):
+        ultrasound_dates = []
+        for x in range(0, (end_date - start_date).days + 1):
+            ultrasound_date = end_date - datetime.timedelta(days=x)
+            if self.state.is_day_finished(ultrasound_date):
+                logger.info(f"Skipping ultrasound date {ultrasound_date}: already finished")
+                continue
+            ultrasound_dates.append(ultrasound_date)
+        return ultrasound_dates
+
+    # Processes the ultrasound dates between start_date and end_date (both included) that are not finished. With
+    # dry_run, returns the plan of each date instead. The pools are opened once for all the dates, unless the pools of
+    # the caller (e.g. the daemon) are given
+    def sync(self, start_date, end_date, dry_run=False, pools=None):
+        ultrasound_dates = self.pending_dates(start_date, end_date)
+        plan = []
+        if not ultrasound_dates:
+            return plan
+        # One query for the whole window instead of one per day
+        events_by_date = self.dhis2.get_events_by_date(min(ultrasound_dates), max(ultrasound_dates))
+        with nullcontext(pools) if pools or dry_run else self.pools() as pools:
+            for ultrasound_date in ultrasound_dates:
+                events = events_by_date.get(ultrasound_date.strftime("%Y-%m-%d"), [])
+                if dry_run:
+                    plan.extend(self.plan_date(ultrasound_date, events))
+                else:
+                    self.run_date(ultrasound_date, pools, events)
+        return plan
+
+    # Processes the last backfill_days ultrasound dates that are not finished
+    def sweep(self, pools=None):
+        today = date.today()
+        return self.sync(today - datetime.timedelta(days=self.config.backfill_days - 1), today, pools=pools)
+
+    # Resolves the dhis2 event of the patient for the date and runs the pipeline for it alone
+    def process_change(self, id_unico, study_date, encode_pool, upload_pool):
+        from ecopulmonar.dhis2 import index_events
+
+        events_without_video, _ = index_events(self.config, self.dhis2.get_patient_events(id_unico, study_date), self.state.has_pending_instances)
+        if not events_without_video:
+            logger.info(f"{id_unico}: No event without video for ultrasound date {study_date}. Left to the sweep")
+            return
+        if len(events_without_video) != 1:
+            logger.error(f"{id_unico}: {len(events_without_video)} events without video for ultrasound date {study_date}: {', '.join(events_without_video.by_uid)}")
+            return
+        event = next(iter(events_without_video))
+        events_without_video.set_id_unico(event, id_unico)
+        metrics.count("events_without_video")
+
+        upload_future = self.process_patient(id_unico, study_date, self.orthanc.get_studies(study_date, id_unico).get(id_unico, []),
+                                             events_without_video, encode_pool, upload_pool)
+        if upload_future:
+            upload_future.result()
+
+
+# Pipeline of the worker processes of the encode pool, created by init_worker with the config of the parent
+worker_pipeline = None
+
+
+# orthanc_slots is the semaphore of the Orthanc downloads of all the workers. log_handlers are the (filename, level,
+# formatter) of the log files of the parent, which the worker appends to
+def init_worker(config, orthanc_slots=None, log_handlers=(), log_level=logging.WARNING):
+    global worker_pipeline
+    root_logger = logging.getLogger()
+    root_logger.setLevel(log_level)
+    for filename, level, formatter in log_handlers:
+        handler = logging.FileHandler(filename, encoding='utf-8')
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+        root_logger.addHandler(handler)
+    worker_pipeline = Pipeline(config, orthanc_slots)
+
+
+# Runs generate_video in a worker process of the encode pool. Returns the filename_video with the metrics of the
+# worker, to be merged into the metrics of the run
+def generate_video_in_worker(instance_id, instance=None):
+    metrics.reset()
+    return worker_pipeline.generate_video(instance_id, instance), metrics.snapshot()
@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+
+import datetime
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+# Local state of the pipeline, so a rerun resumes each instance from its last completed stage:
+# generated -> uploaded -> stored -> attached
+class StateStore:
+    STAGES = ("generated", "uploaded", "stored", "attached")
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS instances (
+                instance_id TEXT PRIMARY KEY,
+                event_uid TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                video_path TEXT,
+                checksum TEXT,
+                file_resource_uid TEXT,
+                updated_at TEXT NOT NULL)""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS days (
+                ultrasound_date TEXT PRIMARY KEY,
+                finished_at TEXT NOT NULL)""")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS cursors (
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL)""")
+
+    def get_instance(self, instance_id):
+        with self.lock:
+            return self.connection.execute("SELECT * FROM instances WHERE instance_id = ?", (instance_id,)).fetchone()
+
+    def save_video(self, instance_id, event_uid, video_path, checksum):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO instances VALUES (?, ?, 'generated', ?, ?, NULL, ?)",
+                                    (instance_id, event_uid, video_path, checksum, datetime.datetime.now().isoformat()))
+
+    def set_stage(self, instance_id, stage, file_resource_uid=None):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE instances SET stage = ?, file_resource_uid = COALESCE(?, file_resource_uid), updated_at = ? WHERE instance_id = ?",
+                                    (stage, file_resource_uid, datetime.datetime.now().isoformat(), instance_id))
+
+    # Back to 'generated' without file resource, so the next run uploads the video again. For file resources that
+    # FAILED or were never STORED
+    def reset_upload(self, instance_id):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE instances SET stage = 'generated', file_resource_uid = NULL, updated_at = ? WHERE instance_id = ?",
+                                    (datetime.datetime.now().isoformat(), instance_id))
+
+    # An event is finished when it has instances and all of them are attached
+    def is_event_finished(self, event_uid):
+        with self.lock:
+            stages = [row["stage"] for row in self.connection.execute("SELECT stage FROM instances WHERE event_uid = ?", (event_uid,))]
+        return bool(stages) and all(stage == "attached" for stage in stages)
+
+    # True if the event has instances that are not attached yet
+    def has_pending_instances(self, event_uid):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM instances WHERE event_uid = ? AND stage != 'attached'", (event_uid,)).fetchone() is not None
+
+    # Set of the instances whose video is not attached yet, so it must be kept on disk
+    def unattached_instances(self):
+        with self.lock:
+            return {row["instance_id"] for row in self.connection.execute("SELECT instance_id FROM instances WHERE stage != 'attached'")}
+
+    def is_day_finished(self, ultrasound_date):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM days WHERE ultrasound_date = ?", (ultrasound_date.isoformat(),)).fetchone() is not None
+
+    def finish_day(self, ultrasound_date):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO days VALUES (?, ?)", (ultrasound_date.isoformat(), datetime.datetime.now().isoformat()))
+
+    # Position of the daemon in a feed, such as the sequence number of the last Orthanc change processed
+    def get_cursor(self, name):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM cursors WHERE name = ?", (name,)).fetchone()
+        return row["value"] if row else None
+
+    def set_cursor(self, name, value):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?)", (name, str(value)))
+
+    # Summary for the status command: number of instances per stage, finished dates and cursors
+    def summary(self):
+        with self.lock:
+            stages = dict(self.connection.execute("SELECT stage, COUNT(*) FROM instances GROUP BY stage").fetchall())
+            days = self.connection.execute("SELECT COUNT(*), MAX(ultrasound_date) FROM days").fetchone()
+            cursors = dict(self.connection.execute("SELECT name, value FROM cursors").fetchall())
+            last_update = self.connection.execute("SELECT MAX(updated_at) FROM instances").fetchone()[0]
+        return {"instances": {stage: stages.get(stage, 0) for stage in self.STAGES}, "last_update": last_update,
+                "finished_days": days[0], "last_finished_day": days[1], "cursors": cursors}
+
+
+def file_checksum(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# True if the video recorded as generated is still on disk and unchanged
+def is_video_valid(record):
+    return record["video_path"] is not None and os.path.isfile(record["video_path"]) and file_checksum(record["video_path"]) == record["checksum"]
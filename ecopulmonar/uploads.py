@@ -0,0 +1,143 @@
+# -*- coding: UTF-8 -*-
+
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import requests
+
+from ecopulmonar.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# multipart/form-data body with a single file, read from disk in chunks as it is sent. Its length is known in advance,
+# so requests sends it with a Content-Length instead of building the whole body in memory
+class MultipartFileBody:
+    def __init__(self, filename, field="file", content_type="video/mp4"):
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=" + boundary
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{os.path.basename(filename)}"\r\n'
+                f'Content-Type: {content_type}\r\n\r\n').encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.file = open(filename, 'rb')
+        self.parts = deque([BytesIO(head), self.file, BytesIO(tail)])
+        self.length = len(head) + os.path.getsize(filename) + len(tail)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and (size < 0 or size > 0):
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.popleft()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Uploads the videos to dhis2 and adds them to the events, recording each stage in the state store
+class Uploader:
+    def __init__(self, config, dhis2, state):
+        self.config = config
+        self.dhis2 = dhis2
+        self.state = state
+
+    # Returns the uid of the fileresource. The video is streamed from disk, and the upload is repeated with backoff on
+    # connection errors, timeouts and 5xx responses
+    def post_video(self, filename):
+        url_resource = self.dhis2.url + "fileResources"
+        logger.debug("%s", url_resource)
+        retries = self.config.upload_retries
+        for attempt in range(1, retries + 1):
+            try:
+                with MultipartFileBody(filename) as body, metrics.timer("upload"):
+                    response = self.dhis2.session.post(url_resource, data=body, headers={"Content-Type": body.content_type},
+                                                       timeout=(30, self.config.upload_timeout))
+                # If response code is not ok (200), print the resulting http error code with description
+                response.raise_for_status()
+                logger.debug("%s", response.text)
+                metrics.count("upload_bytes", len(body))
+                metrics.count("videos_uploaded")
+                return response.json()["response"]["fileResource"]["id"]
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+                if isinstance(e, requests.exceptions.HTTPError) and e.response.status_code < 500:
+                    raise
+                if attempt == retries:
+                    raise
+                metrics.count("upload_retries")
+                delay = min(self.config.upload_backoff * 2 ** (attempt - 1), 300)
+                logger.warning(f"Upload of {filename} failed (attempt {attempt}/{retries}): {e}. Retrying in {delay:.0f}s")
+                time.sleep(delay)
+
+    def send_video(self, event_uid, instance_id, video_path, video_de):
+        return self.send_videos(event_uid, [(instance_id, video_path, video_de)])
+
+    # Uploads all the (instance_id, video_path, video_de) of the event at once and adds each file resource to the event
+    # as soon as it is stored. Videos already uploaded in a previous run reuse their file resource. instance_id may be
+    # None for a file that is not tracked in the state store. Returns the number of videos added to the event
+    def send_videos(self, event_uid, videos):
+        def post(instance_id, video_path, video_de):
+            record = self.state.get_instance(instance_id) if instance_id else None
+            if record and record["file_resource_uid"]:
+                logger.info(f"Event ({event_uid}): Video '{video_path}' already uploaded as File Resource '{record['file_resource_uid']}'")
+                return record["file_resource_uid"]
+            logger.info(f"Event ({event_uid}): Start uploading video to dhis2 '{video_path}' in DE ({video_de})")
+            file_resource_uid = self.post_video(video_path)
+            if instance_id:
+                self.state.set_stage(instance_id, "uploaded", file_resource_uid)
+            logger.info(f"Uploaded file {video_path} to dhis2 and generated a File Resource with uid '{file_resource_uid}'")
+            return file_resource_uid
+
+        with ThreadPoolExecutor(max_workers=len(videos)) as executor:
+            file_resource_uids = list(executor.map(lambda video: post(*video), videos))
+        instances = dict(zip(file_resource_uids, videos))
+
+        def on_stored(file_resource_uid):
+            instance_id, video_path, video_de = instances[file_resource_uid]
+            if instance_id:
+                self.state.set_stage(instance_id, "stored")
+            # Add FileResource to the event
+            self.dhis2.add_file_to_event(event_uid, video_de, file_resource_uid)
+            if instance_id:
+                self.state.set_stage(instance_id, "attached")
+            metrics.count("videos_attached")
+
+        failed = self.dhis2.wait_for_storage(file_resource_uids, on_stored)
+        for file_resource_uid in failed:
+            instance_id, video_path, video_de = instances[file_resource_uid]
+            logger.error(f"Event ({event_uid}): File Resource {file_resource_uid} not stored. DE ({video_de}) not updated")
+            # The file resource is not reused: dhis2 does not retry a FAILED storage and may drop a PENDING one
+            if instance_id:
+                self.state.reset_upload(instance_id)
+        return len(videos) - len(failed)
+
+    # videos is the ordered list of (instance_id, video_path) of the event. The index of the video selects its DE
+    def upload_event_videos(self, event_uid, id_unico, patologia, videos):
+        # Uploading videos to dhis2. Videos attached in a previous run are skipped
+        video_des = self.config.video_des(patologia)
+        videos_de = [(instance_id, video_path, video_des[idx_video]) for idx_video, (instance_id, video_path) in enumerate(videos)
+                     if self.state.get_instance(instance_id)["stage"] != "attached"]
+        if not videos_de:
+            logger.info(f"{id_unico}: All the videos of event ({event_uid}) were already attached")
+            return
+        logger.info(f"Uploading {len(videos_de)} videos for event {event_uid}")
+        uploaded = self.send_videos(event_uid, videos_de)
+        logger.info(f'{id_unico}: Uploaded {uploaded} of {len(videos_de)} videos for event ({event_uid})')
@@ -0,0 +1,15 @@
+# -*- coding: UTF-8 -*-
+
+from collections import deque
+
+
+# Runs fn(item) in the executor for each item with at most window calls in flight, yielding the results in the order of
+# the items as soon as each one is available
+def map_ordered(executor, fn, items, window):
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()